@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Times each stage of the pipeline, with its peak memory, on synthetic 24-channel EEG of different lengths and sample
+# rates, then checks that the reference recording still produces the committed sequence and summary
+
+import csv
+import datetime
+import matplotlib
+matplotlib.use("Agg") # before edf2csv.py imports pyplot
+import edf2csv
+import eegio
+import graph
+import multiprocessing
+import numpy as np
+import os
+import process
+import pyedflib
+import resource
+import sys
+import time
+
+OUT_DIR = "output/benchmark"
+DURATIONS_S = [60, 600, 3600] # e.g. add 86400 for a whole day
+SAMPLE_RATES = [256]
+SEED = 1
+REPORT_FILE = "output/benchmark/benchmark.csv"
+
+# Reference check: edf2csv.py's output for the recording the committed data files were made from; skipped if missing
+REFERENCE_INPUT_FILE = "output/GUICHARD_081217.csv"
+REFERENCE_SEQUENCE_FILE = "data/ck_sequence.csv"
+REFERENCE_SUMMARY_FILE = "data/report_summary.csv"
+SUMMARY_TOLERANCE = 1e-9 # summary values may differ by float rounding, e.g. from summing in a different order
+
+# Writes an .edf of each of eegio.py's LABELS: sines whose amplitude and frequency drift over minutes, plus noise
+def writeSyntheticEdf(filename, seconds, sampleRate, seed=SEED):
+    rng = np.random.RandomState(seed)
+    labels = eegio.LABELS
+    f = pyedflib.EdfWriter(filename, len(labels), file_type=pyedflib.FILETYPE_EDFPLUS)
+    f.setSignalHeaders([{
+        'label': label,
+        'dimension': 'uV',
+        'sample_rate': sampleRate,
+        'physical_max': 3276.7,
+        'physical_min': -3276.8,
+        'digital_max': 32767,
+        'digital_min': -32768,
+        'transducer': '',
+        'prefilter': ''
+    } for label in labels])
+    f.setStartdatetime(datetime.datetime(2017, 12, 8, 22, 0, 0))
+    channels = np.arange(len(labels))[:, np.newaxis]
+    chunkS = 60
+    for s0 in range(0, seconds, chunkS):
+        t = np.arange(s0 * sampleRate, min(s0 + chunkS, seconds) * sampleRate) / float(sampleRate)
+        frequency = 2 + channels % 12 + 3 * np.sin(2 * np.pi * t / 120.0 + channels)
+        amplitude = 20 + 15 * np.sin(2 * np.pi * t / 60.0 + channels * 0.3)
+        signals = amplitude * np.sin(2 * np.pi * frequency * t + channels) + rng.randn(len(labels), len(t)) * 5
+        f.writeSamples(list(np.round(signals, 1)))
+    f.close()
+
+# Peak memory of this process so far, in MB
+def getPeakMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Runs every stage on one duration and sample rate; run in its own process so peak memory is only this case's
+def runCase(case):
+    seconds, sampleRate = case
+    name = "%ss_%shz" % (seconds, sampleRate)
+    caseDir = os.path.join(OUT_DIR, name)
+    if not os.path.isdir(caseDir):
+        os.makedirs(caseDir)
+    edfFile = os.path.join(caseDir, "synthetic.edf")
+    csvFile = os.path.join(caseDir, "synthetic.csv")
+    if not os.path.isfile(edfFile):
+        writeSyntheticEdf(edfFile, seconds, sampleRate)
+
+    results = []
+    def timed(stage, calculate):
+        start = time.time()
+        value = calculate()
+        results.append({"case": name, "stage": stage, "seconds": round(time.time() - start, 4), "peak_mb": round(getPeakMB(), 1)})
+        return value
+
+    f, channels, samplesPerSecond = eegio.openEdf(edfFile, eegio.LABELS)
+    timed("edf2csv", lambda: edf2csv.writeWindow(f, channels, samplesPerSecond, 0, seconds, csvFile))
+    f._close()
+
+    overrides = process.getOutputOverrides(caseDir)
+    overrides.update({"EEG_INPUT_FORMAT": "csv", "EEG_INPUT_FILE": csvFile, "CACHE_DIR": ""})
+    config = process.getConfig(**overrides)
+    instruments = process.readInstruments(config)
+    times, readings = timed("load", lambda: process.readEEG(config))
+    measures = process.getMeasures(config, times, readings)
+    features = timed("features", lambda: process.getMeasureFeatures(config, measures, process.getSampleRate(times)))
+    values = timed("normalize", lambda: process.normalizeFeatures(config, features))
+    process.addFeaturesToMeasures(config, measures, values)
+    table = timed("match", lambda: process.matchInstruments(config, process.compileInstruments(config, instruments), values))
+    for mindex, _instruments in enumerate(table):
+        measures[mindex]["instruments"] = _instruments
+    song_instruments = process.getSongInstruments(config, instruments)
+    events = process.mergeEvents(process.generateAllEvents(config, measures, song_instruments))
+    timed("sequence", lambda: process.writeSequence(config, events, instruments))
+
+    samples = int(seconds * samplesPerSecond)
+    graphSamples = min(samples, int(graph.SECONDS_PER_GRAPH * samplesPerSecond))
+    segment = (edfFile, 0, graphSamples, 1.0 * graphSamples / samplesPerSecond, os.path.join(caseDir, "graph.png"))
+    timed("graph", lambda: graph.renderSegment(segment))
+    return results
+
+# Runs process.py on the reference input and compares its outputs to the committed ones; returns a list of failures
+def checkReference():
+    referenceDir = os.path.join(OUT_DIR, "reference")
+    if not os.path.isdir(referenceDir):
+        os.makedirs(referenceDir)
+    overrides = process.getOutputOverrides(referenceDir)
+    overrides.update({"EEG_INPUT_FORMAT": "csv", "EEG_INPUT_FILE": REFERENCE_INPUT_FILE, "CACHE_DIR": ""})
+    config = process.getConfig(**overrides)
+    process.run(config)
+
+    failures = []
+    with open(REFERENCE_SEQUENCE_FILE, 'rb') as f:
+        expected = f.read()
+    with open(config['SEQUENCE_OUTPUT_FILE'], 'rb') as f:
+        actual = f.read()
+    if actual != expected:
+        failures.append("%s differs from %s" % (config['SEQUENCE_OUTPUT_FILE'], REFERENCE_SEQUENCE_FILE))
+
+    expected = process.readCSV(REFERENCE_SUMMARY_FILE)
+    actual = process.readCSV(config['REPORT_SUMMARY_OUTPUT_FILE'])
+    if len(actual) != len(expected):
+        failures.append("%s has %s rows, expected %s" % (config['REPORT_SUMMARY_OUTPUT_FILE'], len(actual), len(expected)))
+    for i, (a, e) in enumerate(zip(actual, expected)):
+        for key in e:
+            same = abs(a[key] - e[key]) <= SUMMARY_TOLERANCE if isinstance(e[key], float) else a[key] == e[key]
+            if not same:
+                failures.append("%s row %s %s is %s, expected %s" % (config['REPORT_SUMMARY_OUTPUT_FILE'], i + 1, key, a[key], e[key]))
+    return failures
+
+if __name__ == "__main__":
+    if not os.path.isdir(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    cases = [(seconds, sampleRate) for sampleRate in SAMPLE_RATES for seconds in DURATIONS_S]
+
+    # One case at a time, each in a new process
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = []
+    for caseResults in pool.imap(runCase, cases):
+        results += caseResults
+    pool.close()
+    pool.join()
+
+    print "%-16s %-10s %10s %10s" % ("case", "stage", "seconds", "peak MB")
+    for result in results:
+        print "%-16s %-10s %10s %10s" % (result["case"], result["stage"], result["seconds"], result["peak_mb"])
+    with open(REPORT_FILE, 'wb') as f:
+        w = csv.DictWriter(f, fieldnames=["case", "stage", "seconds", "peak_mb"])
+        w.writeheader()
+        w.writerows(results)
+    print "Wrote %s" % REPORT_FILE
+
+    if not os.path.isfile(REFERENCE_INPUT_FILE):
+        print "Skipping reference check, %s not found" % REFERENCE_INPUT_FILE
+        sys.exit(0)
+    failures = checkReference()
+    for failure in failures:
+        print "FAILED: %s" % failure
+    if len(failures) > 0:
+        sys.exit(1)
+    print "Reference outputs match %s and %s" % (REFERENCE_SEQUENCE_FILE, REFERENCE_SUMMARY_FILE)
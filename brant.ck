@@ -1,6 +1,10 @@
 4000 => int padding;
 2 => int instrument_buffers;
 0 => int start;
+0 => int binary_sequence; // 1 = read data/ck_sequence.bin, written by process.py with SEQUENCE_FORMAT = 'binary'
+0 => int follow_sequence; // 1 = keep playing data/ck_sequence.csv as process.py --stream appends to it; start process.py first
+100 => int follow_poll_ms; // how often to check for appended events when following
+10000 => int follow_timeout_ms; // stop following once nothing has been appended for this long
 me.sourceDir() => string base_dir;
 
 // normalize base directory
@@ -19,12 +23,23 @@ class Instrument {
 // data files
 base_dir + "data/ck_instruments.csv" => string instruments_file;
 base_dir + "data/ck_sequence.csv" => string sequence_file;
+if (binary_sequence)
+{
+    base_dir + "data/ck_sequence.bin" => sequence_file;
+}
 
 // read data files
 FileIO instruments_fio;
 FileIO sequence_fio;
 instruments_fio.open( instruments_file, FileIO.READ );
-sequence_fio.open( sequence_file, FileIO.READ );
+if (binary_sequence)
+{
+    sequence_fio.open( sequence_file, FileIO.READ | FileIO.BINARY );
+}
+else
+{
+    sequence_fio.open( sequence_file, FileIO.READ );
+}
 
 // check if files are valid
 if( !instruments_fio.good() || !sequence_fio.good() )
@@ -66,13 +81,82 @@ while( instruments_fio.more() )
 padding::ms => now;
 padding => int elapsed_ms;
 
+// position in the sequence file after the last line read, and whether following it has timed out
+0 => int sequence_position;
+0 => int sequence_done;
+
+// read the next line of the sequence; when following, wait for process.py to append one, or return "" and set
+// sequence_done once it hasn't for follow_timeout_ms
+fun string readSequenceLine()
+{
+    if (!follow_sequence)
+    {
+        return sequence_fio.readLine();
+    }
+    0 => int waited_ms;
+    while (true)
+    {
+        if (sequence_fio.more())
+        {
+            sequence_fio.readLine() => string line;
+            // reading past the last complete line gives an empty one
+            if (line.length() > 0)
+            {
+                sequence_fio.tell() => sequence_position;
+                return line;
+            }
+        }
+        if (waited_ms >= follow_timeout_ms)
+        {
+            1 => sequence_done;
+            return "";
+        }
+        follow_poll_ms::ms => now;
+        follow_poll_ms +=> waited_ms;
+        // reopen the file to see what has been appended since it was last read
+        sequence_fio.close();
+        sequence_fio.open( sequence_file, FileIO.READ );
+        sequence_fio.seek( sequence_position );
+    }
+}
+
+// binary sequence starts with the number of events
+0 => int event_count;
+0 => int event_index;
+if (binary_sequence)
+{
+    sequence_fio.readInt(IO.INT32) => event_count;
+}
+
 // read sequence from file
-while( sequence_fio.more() ) {
-    Std.atoi(sequence_fio.readLine()) => int instrument_index;
-    Std.atoi(sequence_fio.readLine()) => int position;
-    Std.atof(sequence_fio.readLine()) => float gain;
-    Std.atof(sequence_fio.readLine()) => float rate;
-    Std.atoi(sequence_fio.readLine()) => int milliseconds;
+while( (binary_sequence && event_index < event_count) || (!binary_sequence && follow_sequence && !sequence_done) || (!binary_sequence && sequence_fio.more()) ) {
+    int instrument_index;
+    int position;
+    float gain;
+    float rate;
+    int milliseconds;
+    if (binary_sequence)
+    {
+        // fixed-width record: int32 index, int32 position, float32 gain, float32 rate, int32 milliseconds
+        sequence_fio.readInt(IO.INT32) => instrument_index;
+        sequence_fio.readInt(IO.INT32) => position;
+        sequence_fio.readFloat(IO.FLOAT32) => gain;
+        sequence_fio.readFloat(IO.FLOAT32) => rate;
+        sequence_fio.readInt(IO.INT32) => milliseconds;
+    }
+    else
+    {
+        Std.atoi(readSequenceLine()) => instrument_index;
+        if (sequence_done)
+        {
+            break;
+        }
+        Std.atoi(readSequenceLine()) => position;
+        Std.atof(readSequenceLine()) => gain;
+        Std.atof(readSequenceLine()) => rate;
+        Std.atoi(readSequenceLine()) => milliseconds;
+    }
+    event_index++;
 
     elapsed_ms + milliseconds => elapsed_ms;
     if (start > elapsed_ms)
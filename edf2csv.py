@@ -4,6 +4,7 @@
 
 import csv
 import datetime
+import eegio
 import json
 import math
 import matplotlib.pyplot as plt
@@ -18,6 +19,14 @@ INFILE = "data/GUICHARD 081217.edf"
 OUTFILE = "output/GUICHARD_081217.csv"
 START_S = 21195
 END_S = 21455
+OUT_DIR = "output"
+CHUNK_S = 60 # seconds of samples to read and write at a time
+OUTPUT_FORMAT = "csv" # csv = text with a Time column, eeg = binary float32 matrix that process.py can memory-map
+DIGITAL = False # eeg only: write the .edf's int16 digital samples and each channel's gain and offset, half the size
+LABELS = eegio.LABELS # channels to read, in order
+# List of (file, start seconds, end seconds) to extract in one run, each to OUT_DIR/{file}_{start}-{end}.{OUTPUT_FORMAT};
+# if empty, START_S to END_S of INFILE is extracted to OUTFILE
+WINDOWS = []
 
 def mean(data):
     n = len(data)
@@ -92,49 +101,45 @@ def stackplot(marray, seconds=None, start_time=None, ylabels=None):
     plt.xlabel('time (s)')
     plt.show()
 
-f = pyedflib.EdfReader(INFILE)
-n = f.signals_in_file
-dur = f.file_duration
-d = f.getStartdatetime()
-labels = f.getSignalLabels()
-labels = labels[:-1]
-
-print "    %s signals in file:" % n
-print "    %s" % ",".join(labels)
-
-minSignal = f.getPhysicalMinimum(0)
-maxSignal = f.getPhysicalMaximum(0)
-
-samples = f.getNSamples()[0]
-sigbufs = np.zeros((n, samples))
-for i in np.arange(n):
-    sigbufs[i, :] = f.readSignal(i)
-
-samplesPerSecond = samples / dur
-i0 = START_S * samplesPerSecond
-i1 = END_S * samplesPerSecond
-
-rows = np.transpose(sigbufs[:-1, i0:i1])
-rows = rows.tolist()
-
-# # normalize rows
-# print "Normalizing rows"
-# for i,row in enumerate(rows):
-#     for j, col in enumerate(row):
-#         rows[i][j] = round(1.0 * (col - minSignal) / (maxSignal - minSignal), 5)
-
-# add seconds to rows
-print "Adding time"
-sStep = 1.0 / samplesPerSecond
-for i, row in enumerate(rows):
-    ms = int(round(i * sStep * 1000))
-    rows[i] = [ms] + row[:]
-
-# stackplot(sigbufs[:, i0:i1], seconds=END_S-START_S, ylabels=labels)
-
-print "Writing to file"
-with open(OUTFILE, 'wb') as f:
-    w = csv.writer(f)
-    w.writerow(["Time"] + labels[:])
-    w.writerows(rows)
-    print "Wrote %s rows to file" % len(rows)
+# Writes the samples between start_s and end_s of an open .edf to a .csv or .eeg, one chunk at a time
+def writeWindow(f, channels, samplesPerSecond, start_s, end_s, outfile):
+    print "Writing %s-%ss to file: %s" % (start_s, end_s, outfile)
+    digital = DIGITAL and OUTPUT_FORMAT == "eeg"
+    chunks = eegio.readChunks(f, channels, samplesPerSecond, start_s, end_s, CHUNK_S, digital)
+    if OUTPUT_FORMAT == "eeg":
+        start = f.getStartdatetime() + datetime.timedelta(seconds=start_s)
+        scale = eegio.getScale(f, channels) if digital else None
+        count = eegio.writeEegFile(outfile, LABELS, samplesPerSecond, chunks, {"start": start.isoformat(), "start_s": start_s}, scale)
+        print "Wrote %s samples to file" % count
+        return
+    count = 0
+    with open(outfile, 'wb') as out:
+        w = csv.writer(out)
+        w.writerow(["Time"] + LABELS)
+        for ms, rows in chunks:
+            w.writerows([[t] + row for t, row in zip(ms.tolist(), rows.tolist())])
+            count += len(rows)
+    print "Wrote %s rows to file" % count
+
+if __name__ == "__main__":
+    # Group windows by file so each .edf is only opened once
+    windows = WINDOWS if len(WINDOWS) > 0 else [(INFILE, START_S, END_S)]
+    files = []
+    for filename, start_s, end_s in windows:
+        if filename not in files:
+            files.append(filename)
+
+    for filename in files:
+        f, channels, samplesPerSecond = eegio.openEdf(filename, LABELS)
+        print "%s:" % filename
+        print "    %s of %s signals in file:" % (len(channels), f.signals_in_file)
+        print "    %s" % ",".join(LABELS)
+        for _filename, start_s, end_s in windows:
+            if _filename != filename:
+                continue
+            if len(WINDOWS) > 0:
+                outfile = "%s/%s_%s-%s.%s" % (OUT_DIR, os.path.basename(filename).split(".")[0].replace(" ", "_"), start_s, end_s, OUTPUT_FORMAT)
+            else:
+                outfile = OUTFILE if OUTPUT_FORMAT == "csv" else os.path.splitext(OUTFILE)[0] + "." + OUTPUT_FORMAT
+            writeWindow(f, channels, samplesPerSecond, start_s, end_s, outfile)
+        f._close()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Keeps a JSON index of .edf header metadata, keyed by path, size and modified time, so recordings only need to be
+# opened again when they change
+
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import pyedflib
+
+INDEX_FILE = "output/edf_index.json"
+PROCESSES = None # number of headers to read at once; None = number of CPUs
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Reads the header of an .edf into an index entry
+def readHeader(path):
+    stat = os.stat(path)
+    f = pyedflib.EdfReader(path)
+    entry = {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "labels": f.getSignalLabels(),
+        "sample_rates": [1.0 * samples / f.file_duration for samples in f.getNSamples()],
+        "duration": f.file_duration,
+        "start": f.getStartdatetime().strftime(DATETIME_FORMAT)
+    }
+    f._close()
+    return entry
+
+def readIndex(filename=INDEX_FILE):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def writeIndex(index, filename=INDEX_FILE):
+    with open(filename, 'w') as f:
+        json.dump(index, f)
+
+# Returns index entries for every .edf in dirs, reading the headers of new or changed files in parallel
+def updateIndex(dirs, filename=INDEX_FILE, processes=PROCESSES):
+    index = readIndex(filename)
+    paths = []
+    for d in dirs:
+        for name in sorted(os.listdir(d)):
+            if name.endswith(".edf"):
+                paths.append(os.path.join(d, name))
+
+    changed = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = index.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            changed.append(path)
+
+    if len(changed) > 0:
+        pool = multiprocessing.Pool(processes)
+        for entry in pool.map(readHeader, changed):
+            index[entry["path"]] = entry
+        pool.close()
+        pool.join()
+
+    # Forget files that no longer exist
+    removed = [path for path in index if not os.path.isfile(path)]
+    for path in removed:
+        del index[path]
+
+    if len(changed) > 0 or len(removed) > 0:
+        writeIndex(index, filename)
+    return [index[path] for path in paths]
+
+def getStart(entry):
+    return datetime.datetime.strptime(entry["start"], DATETIME_FORMAT)
+
+# Returns (path, start seconds, end seconds) of each recording that overlaps the time between start and end, in the
+# same form as edf2csv.py's WINDOWS; label limits it to recordings that have that channel
+def getWindows(entries, start, end, label=None):
+    windows = []
+    for entry in entries:
+        if label is not None and label not in entry["labels"]:
+            continue
+        entryStart = getStart(entry)
+        start_s = max((start - entryStart).total_seconds(), 0)
+        end_s = min((end - entryStart).total_seconds(), entry["duration"])
+        if end_s > start_s:
+            windows.append((entry["path"], int(start_s), int(math.ceil(end_s))))
+    return windows
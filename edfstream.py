@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Replays an .edf as the .csv rows edf2csv.py writes, to stdout or to a client of a local socket, for streaming into
+# process.py, e.g.
+#   python edfstream.py | python process.py --stream
+# or with PORT set:
+#   python edfstream.py & python process.py --stream localhost:8765
+
+import csv
+import eegio
+import socket
+import sys
+import time
+
+INFILE = "data/GUICHARD 081217.edf"
+START_S = 21195
+END_S = 21455
+CHUNK_S = 1 # seconds of samples to send at a time
+REALTIME = True # wait for each chunk's time to pass before sending it, as if it was being recorded; False = as fast as possible
+PORT = None # serve the rows to one client on this local port; None = write them to stdout
+LABELS = eegio.LABELS # channels to read, in order
+
+# Writes rows to out one chunk at a time; returns the number of rows written
+def replay(out):
+    w = csv.writer(out)
+    w.writerow(["Time"] + LABELS)
+    out.flush()
+    count = 0
+    started = time.time()
+    for ms, rows in eegio.readEdfChunks(INFILE, LABELS, START_S, END_S, CHUNK_S):
+        if REALTIME:
+            wait = started + ms[-1] / 1000.0 - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        w.writerows([[t] + row for t, row in zip(ms.tolist(), rows.tolist())])
+        out.flush()
+        count += len(rows)
+    return count
+
+if __name__ == "__main__":
+    if PORT is None:
+        count = replay(sys.stdout)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("localhost", PORT))
+        server.listen(1)
+        print >> sys.stderr, "Waiting for a client on localhost:%s" % PORT
+        connection, address = server.accept()
+        out = connection.makefile('wb')
+        count = replay(out)
+        out.close()
+        connection.close()
+        server.close()
+    print >> sys.stderr, "Streamed %s rows of %s" % (count, INFILE)
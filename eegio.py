@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Reads EEG samples from .edf files and reads/writes them as .eeg files: a fixed-size JSON header followed by a
+# (samples x channels) matrix of little-endian float32 physical values that can be opened with np.memmap, or of the
+# .edf's int16 digital values, with the gain and offset of each channel in the header
+
+import json
+import numpy as np
+import pyedflib
+
+# Channels of the recordings, in the order they are read and written
+LABELS = ['Fp1','Fp2','F3','F4','C3','C4','P3','P4','O1','O2','F7','F8','T3','T4','T5','T6','A1','A2','Fz',
+          'Cz','Pz','T2','T1','Oz']
+
+HEADER_SIZE = 4096 # bytes reserved for the JSON header at the start of .eeg and pyramid.py's .pyr files
+EEG_MAGIC = 'BRANTEEG'
+EEG_DTYPE = '<f4'
+EEG_DIGITAL_DTYPE = '<i2'
+
+# Writes header as JSON after magic at the start of f, an open file whose first HEADER_SIZE bytes were reserved for it
+def writeHeader(f, magic, header):
+    headerString = magic + json.dumps(header)
+    if len(headerString) > HEADER_SIZE:
+        raise ValueError('Header of %s is larger than %s bytes' % (f.name, HEADER_SIZE))
+    f.seek(0)
+    f.write(headerString)
+
+# Returns the header of a file written with writeHeader(), which must start with magic
+def readHeader(filename, magic):
+    with open(filename, 'rb') as f:
+        headerString = f.read(HEADER_SIZE)
+    if not headerString.startswith(magic):
+        raise ValueError('%s is not a %s file' % (filename, magic))
+    return json.loads(headerString[len(magic):])
+
+# Opens an .edf and returns (reader, signal index of each label, samples per second)
+def openEdf(filename, labels):
+    f = pyedflib.EdfReader(filename)
+    fileLabels = f.getSignalLabels()
+    channels = [fileLabels.index(label) for label in labels]
+    samplesPerSecond = f.getNSamples()[channels[0]] / f.file_duration
+    return f, channels, samplesPerSecond
+
+# Returns (gains, offsets) arrays that scale the digital values of channels of an open .edf to physical values:
+# physical = digital * gain + offset
+def getScale(f, channels):
+    gains = np.zeros(len(channels))
+    offsets = np.zeros(len(channels))
+    for j, channel in enumerate(channels):
+        physicalMin, physicalMax = f.getPhysicalMinimum(channel), f.getPhysicalMaximum(channel)
+        digitalMin, digitalMax = f.getDigitalMinimum(channel), f.getDigitalMaximum(channel)
+        gains[j] = 1.0 * (physicalMax - physicalMin) / (digitalMax - digitalMin)
+        offsets[j] = physicalMax - gains[j] * digitalMax
+    return gains, offsets
+
+# Milliseconds elapsed at n samples starting from sample index i0, rounded the same as edf2csv.py's time column
+def getTimes(i0, n, samplesPerSecond):
+    sStep = 1.0 / samplesPerSecond
+    return np.floor(np.arange(i0, i0 + n) * sStep * 1000 + 0.5).astype(int)
+
+# Returns the [i0, i1) sample indexes of an open .edf between start_s and end_s
+def getSampleRange(f, channels, samplesPerSecond, start_s=0, end_s=None):
+    samples = f.getNSamples()[channels[0]]
+    i0 = int(start_s * samplesPerSecond)
+    i1 = samples if end_s is None else min(int(end_s * samplesPerSecond), samples)
+    return i0, max(i1, i0)
+
+# Yields (ms, rows) for consecutive chunks of an open .edf between start_s and end_s, where ms is an array of
+# milliseconds elapsed since start_s and rows is a (samples x channels) array of physical values, or of int16 digital
+# values if digital (see getScale()). Only the requested channels and sample range are read, at most chunk_s seconds
+# at a time.
+def readChunks(f, channels, samplesPerSecond, start_s=0, end_s=None, chunk_s=60, digital=False):
+    i0, i1 = getSampleRange(f, channels, samplesPerSecond, start_s, end_s)
+    chunkSize = max(int(chunk_s * samplesPerSecond), 1)
+
+    i = i0
+    buf = np.empty(chunkSize, dtype=np.int32) if digital else None
+    while i < i1:
+        n = min(chunkSize, i1 - i)
+        rows = np.empty((n, len(channels)), dtype=np.int16 if digital else float)
+        for j, channel in enumerate(channels):
+            if digital:
+                f.read_digital_signal(channel, i, n, buf)
+                rows[:, j] = buf[:n]
+            else:
+                rows[:, j] = f.readSignal(channel, i, n)
+        yield getTimes(i - i0, n, samplesPerSecond), rows
+        i += n
+
+# Yields (ms, rows) chunks of an .edf file, see readChunks()
+def readEdfChunks(filename, labels, start_s=0, end_s=None, chunk_s=60, digital=False):
+    f, channels, samplesPerSecond = openEdf(filename, labels)
+    try:
+        for chunk in readChunks(f, channels, samplesPerSecond, start_s, end_s, chunk_s, digital):
+            yield chunk
+    finally:
+        f._close()
+
+# Returns (ms, rows) of an .edf file between start_s and end_s, see readChunks(). rows is allocated once from the
+# header's sample count and filled a chunk at a time, so only one chunk is held besides it
+def readEdf(filename, labels, start_s=0, end_s=None, chunk_s=60, digital=False):
+    f, channels, samplesPerSecond = openEdf(filename, labels)
+    try:
+        i0, i1 = getSampleRange(f, channels, samplesPerSecond, start_s, end_s)
+        rows = np.empty((i1 - i0, len(channels)), dtype=np.int16 if digital else float)
+        i = 0
+        for ms, chunk in readChunks(f, channels, samplesPerSecond, start_s, end_s, chunk_s, digital):
+            rows[i:i+len(chunk)] = chunk
+            i += len(chunk)
+    finally:
+        f._close()
+    return getTimes(0, len(rows), samplesPerSecond), rows
+
+# Writes (ms, rows) chunks to an .eeg file as they are read; header is a dict of extra metadata, e.g. start time. With
+# the (gains, offsets) of getScale(), rows are digital values and are written as int16
+def writeEegFile(filename, labels, samplesPerSecond, chunks, header={}, scale=None):
+    samples = 0
+    dtype = EEG_DTYPE if scale is None else EEG_DIGITAL_DTYPE
+    with open(filename, 'wb') as f:
+        f.write(' ' * HEADER_SIZE)
+        for ms, rows in chunks:
+            f.write(np.asarray(rows, dtype=dtype).tobytes())
+            samples += len(rows)
+        # Now that the number of samples is known, write the header
+        _header = dict(header)
+        _header.update({
+            'labels': list(labels),
+            'sample_rate': samplesPerSecond,
+            'samples': samples,
+            'dtype': dtype
+        })
+        if scale is not None:
+            _header['gains'] = list(scale[0])
+            _header['offsets'] = list(scale[1])
+        writeHeader(f, EEG_MAGIC, _header)
+    return samples
+
+# Rows of a (samples x channels) array, e.g. a memory-mapped .eeg, with only some of its channels, in any order.
+# Slicing rows returns another view; the channels are only selected, i.e. copied into memory, when a view is converted
+# to an array, e.g. one measure at a time
+class ChannelView(object):
+
+    def __init__(self, rows, channels):
+        self.rows = rows
+        self.channels = channels
+        self.shape = (len(rows), len(channels))
+        self.dtype = rows.dtype
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        return ChannelView(self.rows[key], self.channels)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.rows[:, self.channels], dtype=dtype)
+
+# Returns the header of an .eeg file
+def readEegHeader(filename):
+    return readHeader(filename, EEG_MAGIC)
+
+# Returns (header, readings) of an .eeg file, where readings is a read-only (samples x channels) np.memmap; if the
+# header has gains and offsets, readings are digital values
+def readEegFile(filename):
+    header = readEegHeader(filename)
+    shape = (header['samples'], len(header['labels']))
+    if header['samples'] < 1:
+        return header, np.zeros(shape, dtype=header['dtype'])
+    readings = np.memmap(filename, dtype=header['dtype'], mode='r', offset=HEADER_SIZE, shape=shape)
+    return header, readings
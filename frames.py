@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Renders the frames of the visualization in visualization/visualization.pde without Processing or a display: the
+# scrolling channel traces of the EEG that process.py reads, with the sequence's events, split across a process pool
+# and piped into a video (or written as .png frames like the sketch's captureFrames)
+
+import graph
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import multiprocessing
+import numpy as np
+import os
+import process
+import render
+import subprocess
+
+SEQUENCE_FILE = "data/ck_sequence.csv"
+VIDEO_FILE = "output/brant.mp4" # None = write .png frames to OUTPUT_FRAME_FILE instead
+OUTPUT_FRAME_FILE = "output/frames/frames-%05d.png"
+FFMPEG = "ffmpeg"
+FPS = 30
+WIDTH = 1280
+HEIGHT = 720
+START_MS = 0
+STOP_MS = None # None = the end of the EEG
+FRAMES_PER_JOB = 300 # frames each process renders into a video segment at a time
+PROCESSES = None # None = number of CPUs
+
+# Layout, same as visualization.pde
+LABEL_W = 100
+MARKER_W = 10
+POINT_D = 10
+PIXELS_PER_MS = 90.0 / 1000
+READING_PADDING = 40
+FONT_SIZE = 18
+EVENTS_H = 30 # height of the strip of sequence events along the bottom
+EVENT_MS = 100 # events are highlighted while they are this close to the marker
+
+# Colors, same as visualization.pde
+BG_COLOR = "#262222"
+TEXT_COLOR = "#f8f3f3"
+LINE_COLOR = "#6b6961"
+LINE_START_COLOR = "#ffffff"
+POINT_COLOR = "#ffe030"
+HIGHLIGHT_COLOR = "#ef6e6e"
+
+# Each worker gets the readings and events once, when it starts, and keeps one figure it redraws for every frame
+state = {"times": None, "readings": None, "labels": None, "events": None, "figure": None}
+
+def setState(times, readings, labels, events):
+    state["times"] = times
+    state["readings"] = readings
+    state["labels"] = labels
+    state["events"] = events
+
+def hexToRgb(color):
+    return np.array([int(color[i:i+2], 16) for i in (1, 3, 5)]) / 255.0
+
+# Fades traces into the background away from the marker: an image of the background color that is transparent at
+# the marker and opaque at the edges, as the sketch's line gradients do
+def getFade(plotW, markerX):
+    x = np.arange(plotW) + 0.5
+    alpha = np.where(x < markerX, 1.0 - x / markerX, (x - markerX) / (plotW - markerX))
+    fade = np.zeros((1, plotW, 4))
+    fade[0, :, :3] = hexToRgb(BG_COLOR)
+    fade[0, :, 3] = alpha
+    return fade
+
+# Creates the figure, with the artists every frame updates
+def createFigure():
+    labels = state["labels"]
+    plotW = WIDTH - LABEL_W
+    markerX = 0.5 * (WIDTH - LABEL_W / 2)
+    labelH = 1.0 * (HEIGHT - EVENTS_H) / len(labels)
+
+    dpi = 72
+    fig = plt.figure(figsize=(1.0 * WIDTH / dpi, 1.0 * HEIGHT / dpi), dpi=dpi, facecolor=BG_COLOR)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(0, WIDTH)
+    ax.set_ylim(HEIGHT, 0)
+    ax.axis("off")
+
+    before = [ax.plot([], [], color=LINE_COLOR, linewidth=1)[0] for label in labels]
+    after = [ax.plot([], [], color=LINE_START_COLOR, linewidth=1.5)[0] for label in labels]
+    ax.imshow(getFade(plotW, markerX), extent=(0, plotW, HEIGHT, 0), aspect="auto", zorder=3)
+    ax.add_patch(plt.Rectangle((markerX - MARKER_W / 2.0, 0), MARKER_W, HEIGHT, color=TEXT_COLOR, alpha=0.3, linewidth=0, zorder=4))
+    points = ax.scatter([markerX] * len(labels), np.zeros(len(labels)), s=POINT_D ** 2 / 2, color=POINT_COLOR, zorder=5)
+    events = ax.scatter([], [], s=9, zorder=5)
+
+    ax.add_patch(plt.Rectangle((plotW, 0), LABEL_W, HEIGHT, color=BG_COLOR, linewidth=0, zorder=6))
+    for i, label in enumerate(labels):
+        ax.text(plotW + 20, labelH * (i + 0.5), label, color=TEXT_COLOR, fontsize=FONT_SIZE, va="center", zorder=7)
+
+    return {
+        "figure": fig,
+        "before": before,
+        "after": after,
+        "points": points,
+        "events": events,
+        "plotW": plotW,
+        "markerX": markerX,
+        "labelH": labelH
+    }
+
+# Draws the frame at elapsedMs; returns the figure
+def drawFrame(elapsedMs):
+    if state["figure"] is None:
+        state["figure"] = createFigure()
+    frame = state["figure"]
+    times, readings, events = state["times"], state["readings"], state["events"]
+    plotW, markerX, labelH = frame["plotW"], frame["markerX"], frame["labelH"]
+
+    # Channels of the readings on screen, reduced to the points that can be seen at this width
+    screenStartMs = elapsedMs - markerX / PIXELS_PER_MS
+    screenEndMs = elapsedMs + (plotW - markerX) / PIXELS_PER_MS
+    i0, i1 = np.searchsorted(times, [screenStartMs, screenEndMs])
+    i0, i1 = max(i0 - 1, 0), min(i1 + 1, len(times))
+    rowY = labelH * np.arange(readings.shape[1])[:, np.newaxis] - READING_PADDING
+    if i1 - i0 > 1:
+        indexes, values = graph.decimate(readings[i0:i1].T, plotW)
+        x = markerX + (times[i0:i1][indexes] - elapsedMs) * PIXELS_PER_MS
+        y = values * (labelH + READING_PADDING * 2) + rowY
+    else:
+        x = y = np.zeros((readings.shape[1], 0))
+    for i in range(readings.shape[1]):
+        split = np.searchsorted(x[i], markerX)
+        frame["before"][i].set_data(x[i][:split + 1], y[i][:split + 1])
+        frame["after"][i].set_data(x[i][split:], y[i][split:])
+
+    # Values at the marker
+    current = min(np.searchsorted(times, elapsedMs), len(times) - 1)
+    pointY = readings[current] * (labelH + READING_PADDING * 2) + rowY[:, 0]
+    frame["points"].set_offsets(np.column_stack(([markerX] * len(pointY), pointY)))
+
+    # Sequence events on screen, one row per instrument, highlighted as they play
+    e0, e1 = np.searchsorted(events["ms"], [screenStartMs, screenEndMs])
+    eventX = markerX + (events["ms"][e0:e1] - elapsedMs) * PIXELS_PER_MS
+    eventY = HEIGHT - EVENTS_H + events["row"][e0:e1] * (EVENTS_H - 4) + 2
+    playing = np.abs(events["ms"][e0:e1] - elapsedMs) < EVENT_MS
+    frame["events"].set_offsets(np.column_stack((eventX, eventY)) if e1 > e0 else np.zeros((0, 2)))
+    frame["events"].set_color([HIGHLIGHT_COLOR if p else LINE_COLOR for p in playing])
+    return frame["figure"]
+
+# Renders frames [f0, f1) to the video segment or .png frames; run in a worker
+def renderFrames(job):
+    f0, f1, segmentFile = job
+    ffmpeg = None
+    if segmentFile is not None:
+        ffmpeg = subprocess.Popen([FFMPEG, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", "%sx%s" % (WIDTH, HEIGHT), "-r", str(FPS), "-i", "-", "-pix_fmt", "yuv420p", segmentFile],
+            stdin=subprocess.PIPE)
+    for i in range(f0, f1):
+        fig = drawFrame(START_MS + i * 1000.0 / FPS)
+        if ffmpeg is not None:
+            fig.canvas.draw()
+            ffmpeg.stdin.write(fig.canvas.tostring_rgb())
+        else:
+            fig.savefig(OUTPUT_FRAME_FILE % (i + 1), facecolor=BG_COLOR)
+    if ffmpeg is not None:
+        ffmpeg.stdin.close()
+        ffmpeg.wait()
+    return f0, f1
+
+# Times of the sequence's events and the row of their instrument in the events strip, from 0 to 1
+def readEvents(filename):
+    sequence = render.readSequence(filename)
+    index = sequence[:, 0].astype(int)
+    instruments = np.unique(index)
+    return {
+        "ms": np.cumsum(sequence[:, 4]),
+        "row": np.searchsorted(instruments, index) / max(len(instruments) - 1.0, 1.0)
+    }
+
+if __name__ == "__main__":
+    config = process.getConfig()
+    times, readings = process.readEEG(config)
+    readings = process.normReadings(config, readings, process.readScale(config))
+    events = readEvents(SEQUENCE_FILE)
+    stopMs = STOP_MS if STOP_MS is not None else times[-1]
+    frameCount = int((stopMs - START_MS) * FPS / 1000.0)
+    print "Rendering %s frames of %s channels, %s events" % (frameCount, readings.shape[1], len(events["ms"]))
+
+    outDir = os.path.dirname(VIDEO_FILE if VIDEO_FILE is not None else OUTPUT_FRAME_FILE)
+    if outDir and not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    jobs = []
+    for f0 in range(0, frameCount, FRAMES_PER_JOB):
+        segmentFile = None
+        if VIDEO_FILE is not None:
+            segmentFile = "%s-%05d%s" % (os.path.splitext(VIDEO_FILE)[0], len(jobs), os.path.splitext(VIDEO_FILE)[1])
+        jobs.append((f0, min(f0 + FRAMES_PER_JOB, frameCount), segmentFile))
+
+    pool = multiprocessing.Pool(PROCESSES, initializer=setState, initargs=(times, readings, config['LABELS'], events))
+    for f0, f1 in pool.imap_unordered(renderFrames, jobs):
+        print "    Rendered frames %s-%s" % (f0 + 1, f1)
+    pool.close()
+    pool.join()
+
+    # Join the segments into one video
+    if VIDEO_FILE is not None:
+        listFile = os.path.splitext(VIDEO_FILE)[0] + "-segments.txt"
+        with open(listFile, "w") as f:
+            for f0, f1, segmentFile in jobs:
+                f.write("file '%s'\n" % os.path.abspath(segmentFile))
+        subprocess.check_call([FFMPEG, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listFile, "-c", "copy", VIDEO_FILE])
+        for f0, f1, segmentFile in jobs:
+            os.remove(segmentFile)
+        os.remove(listFile)
+        print "Wrote %s" % VIDEO_FILE
@@ -4,10 +4,14 @@
 
 import csv
 import datetime
+import eegio
 import json
 import math
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
+import multiprocessing
 import numpy as np
 import os
 from pprint import pprint
@@ -17,15 +21,43 @@ import sys
 IN_DIR = "data"
 OUT_DIR = "output"
 SECONDS_PER_GRAPH = 3600
-
-def stackplot(marray, filename, seconds=None, start_time=None, ylabels=None):
-
-    tarray = np.transpose(marray)
-    data = tarray
-    numSamples, numRows = tarray.shape
+WIDTH = 1920 # graph width in pixels; each channel is decimated to a min/max pair per pixel before plotting
+HEIGHT = 1080
+PROCESSES = None # number of segments to render at once; None = number of CPUs
+
+# Reduce each row of marray (numRows x numSamples) to the min and max of each of {buckets} equal runs of samples,
+# kept in the order they occur, so the trace looks the same when drawn {buckets} pixels wide.
+# Returns (sample index of each point, values), both numRows x (2 * buckets)
+def decimate(marray, buckets):
+    numRows, numSamples = marray.shape
+    if numSamples <= buckets * 2:
+        indexes = np.tile(np.arange(numSamples), (numRows, 1))
+        return indexes, marray
+    size = int(math.ceil(1.0 * numSamples / buckets))
+    buckets = int(math.ceil(1.0 * numSamples / size))
+    padded = np.pad(marray, ((0, 0), (0, buckets * size - numSamples)), mode='edge')
+    padded = padded.reshape(numRows, buckets, size)
+    imin = padded.argmin(axis=2)
+    imax = padded.argmax(axis=2)
+    starts = np.arange(buckets) * size
+    indexes = np.empty((numRows, buckets * 2), dtype=int)
+    indexes[:, 0::2] = starts + np.minimum(imin, imax)
+    indexes[:, 1::2] = starts + np.maximum(imin, imax)
+    indexes = np.minimum(indexes, numSamples - 1)
+    values = marray[np.arange(numRows)[:, np.newaxis], indexes]
+    return indexes, values
+
+# With the (gains, offsets) of eegio.getScale(), marray is digital values and only the decimated points are scaled
+def stackplot(marray, filename, seconds=None, start_time=None, ylabels=None, scale=None):
+
+    numRows, numSamples = marray.shape
+    indexes, data = decimate(marray, WIDTH)
+    if scale is not None:
+        gains, offsets = scale
+        data = data * gains[:, np.newaxis] + offsets[:, np.newaxis]
 
     dpi = 72
-    plt.figure(figsize=(1920.0/dpi, 1080.0/dpi), dpi=dpi)
+    plt.figure(figsize=(1.0*WIDTH/dpi, 1.0*HEIGHT/dpi), dpi=dpi)
 
     if seconds:
         t = seconds * np.arange(numSamples, dtype=float)/numSamples
@@ -51,7 +83,7 @@ def stackplot(marray, filename, seconds=None, start_time=None, ylabels=None):
 
     segs = []
     for i in range(numRows):
-        segs.append(np.hstack((t[:,np.newaxis], data[:,i,np.newaxis])))
+        segs.append(np.hstack((t[indexes[i],np.newaxis], data[i,:,np.newaxis])))
         ticklocs.append(i*dr)
 
     offsets = np.zeros((numRows,2), dtype=float)
@@ -69,41 +101,78 @@ def stackplot(marray, filename, seconds=None, start_time=None, ylabels=None):
     plt.style.use('fivethirtyeight')
     plt.savefig(filename, dpi=dpi, bbox_inches='tight')
     # plt.show()
-
-for filename in os.listdir(IN_DIR):
-    if filename.endswith(".edf"):
-
-        f = pyedflib.EdfReader(os.path.join(IN_DIR, filename))
-        n = f.signals_in_file
-        dur = f.file_duration
-        d = f.getStartdatetime()
-        labels = f.getSignalLabels()
-
-        print "---------\nProcessing: %s" % filename
-        print "    %s signals in file:" % n
-        print "    %s" % ",".join(labels)
-
-        samples = f.getNSamples()[0]
-        sigbufs = np.zeros((n, samples))
-        for i in np.arange(n):
-            sigbufs[i, :] = f.readSignal(i)
-
-        samplesPerSecond = samples / dur
-
-        segmentStartTime = d
-        seconds = 0
-        while seconds < dur:
-            sd = segmentStartTime
-            sampleIndex0 = seconds * samplesPerSecond
-            sampleIndex1 = min(sampleIndex0 + SECONDS_PER_GRAPH * samplesPerSecond, samples)
-            segmentSeconds = (sampleIndex1 - sampleIndex0) / samplesPerSecond
-            segmentName = "%s/%s_%s-%s-%s_%s-%s-%s.png" % (OUT_DIR,filename.split(".")[0],sd.year,sd.month,sd.day,sd.hour,sd.minute,sd.second)
-
-            if os.path.isfile(segmentName):
-                print "    Skipping graph: %s" % segmentName
-            else:
-                print "    Building graph: %s" % segmentName
-                stackplot(sigbufs[:, sampleIndex0:sampleIndex1], segmentName, seconds=segmentSeconds, ylabels=labels)
-
-            seconds += SECONDS_PER_GRAPH
-            segmentStartTime += datetime.timedelta(seconds=segmentSeconds)
+    plt.close()
+
+# Each worker keeps its last opened .edf, since segments of a file are rendered one after another
+reader = {"path": None, "f": None}
+
+def getReader(path):
+    if reader["path"] != path:
+        if reader["f"] is not None:
+            reader["f"]._close()
+        reader["f"] = pyedflib.EdfReader(path)
+        reader["path"] = path
+    return reader["f"]
+
+# Reads only the segment's sample range of every signal, as int16 digital values, and renders it to a .png
+def renderSegment(segment):
+    path, sampleIndex0, sampleIndex1, segmentSeconds, segmentName = segment
+    f = getReader(path)
+    n = f.signals_in_file
+    labels = f.getSignalLabels()
+    count = int(sampleIndex1 - sampleIndex0)
+    sigbufs = np.zeros((n, count), dtype=np.int16)
+    buf = np.empty(count, dtype=np.int32)
+    for i in np.arange(n):
+        f.read_digital_signal(i, int(sampleIndex0), count, buf)
+        sigbufs[i, :] = buf
+    stackplot(sigbufs, segmentName, seconds=segmentSeconds, ylabels=labels, scale=eegio.getScale(f, range(n)))
+    return segmentName
+
+# Lists the segments of an .edf that don't have a graph yet, reading only its header
+def getSegments(filename):
+    segments = []
+    path = os.path.join(IN_DIR, filename)
+    f = pyedflib.EdfReader(path)
+    n = f.signals_in_file
+    dur = f.file_duration
+    d = f.getStartdatetime()
+    labels = f.getSignalLabels()
+    samples = f.getNSamples()[0]
+    f._close()
+
+    print "---------\nProcessing: %s" % filename
+    print "    %s signals in file:" % n
+    print "    %s" % ",".join(labels)
+
+    samplesPerSecond = samples / dur
+
+    segmentStartTime = d
+    seconds = 0
+    while seconds < dur:
+        sd = segmentStartTime
+        sampleIndex0 = seconds * samplesPerSecond
+        sampleIndex1 = min(sampleIndex0 + SECONDS_PER_GRAPH * samplesPerSecond, samples)
+        segmentSeconds = (sampleIndex1 - sampleIndex0) / samplesPerSecond
+        segmentName = "%s/%s_%s-%s-%s_%s-%s-%s.png" % (OUT_DIR,filename.split(".")[0],sd.year,sd.month,sd.day,sd.hour,sd.minute,sd.second)
+
+        if os.path.isfile(segmentName):
+            print "    Skipping graph: %s" % segmentName
+        else:
+            segments.append((path, sampleIndex0, sampleIndex1, segmentSeconds, segmentName))
+
+        seconds += SECONDS_PER_GRAPH
+        segmentStartTime += datetime.timedelta(seconds=segmentSeconds)
+    return segments
+
+if __name__ == "__main__":
+    segments = []
+    for filename in sorted(os.listdir(IN_DIR)):
+        if filename.endswith(".edf"):
+            segments += getSegments(filename)
+
+    pool = multiprocessing.Pool(PROCESSES)
+    for segmentName in pool.imap_unordered(renderSegment, segments):
+        print "    Built graph: %s" % segmentName
+    pool.close()
+    pool.join()
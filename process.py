@@ -1,12 +1,32 @@
 # -*- coding: utf-8 -*-
 
-# Generates graphs for .edf files in directory
+# Builds a ChucK sequence and reports from EEG data
+#
+# Run with no arguments to process the files configured below, or import it and call run(getConfig(...)).
+# To process many recordings at once, each into its own directory:
+#   python process.py output/a.csv output/b.eeg "data/c.edf" --out output/batch --processes 4 --set BPM=100
+# To try many settings on one recording, each variant into its own directory:
+#   python process.py --sweep BPM=60,75,100 --sweep GAIN=0.1,0.2 --out output/sweep
+# To sonify EEG as it arrives, stream it in and play the sequence with brant.ck's follow_sequence set to 1:
+#   python edfstream.py | python process.py --stream
 
+import argparse
+import ast
+import cPickle as pickle
+import cProfile
 import csv
 import datetime
+import eegio
+import hashlib
+import heapq
+import itertools
 import json
 import math
+import multiprocessing
+import numpy as np
 import os
+import resource
+import socket
 import sys
 import time
 
@@ -18,11 +38,19 @@ OUTFILE = "output/GUICHARD_081217.csv"
 BPM = 75 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 16 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 10 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER = 'halton' # halton = numbered across all events in order, as before; counter = hashed from (instrument, measure, beat), so measures can be generated independently
 PRECISION = 6 # decimal places after 0 for reading value
 GAIN = 0.2 # base gain
 TEMPO = 0.25 # base tempo
-LABELS = ['Fp1','Fp2','F3','F4','C3','C4','P3','P4','O1','O2','F7','F8','T3','T4','T5','T6','A1','A2','Fz',
-          'Cz','Pz','T2','T1','Oz']
+MEASURE_BATCH = 256 # number of measures to calculate features for at a time
+MEASURE_HOP_BEATS = 0 # beats between the starts of overlapping measures, e.g. 1 = a measure every beat, so instruments can change every beat; must divide the 4 beats of a measure; 0 = measures don't overlap
+FREQUENCY_BACKEND = 'peaks' # peaks = count waves in each measure, spectral = dominant frequency of each measure's power spectrum
+BANDS = [('delta', 0.5, 4.0), ('theta', 4.0, 8.0), ('alpha', 8.0, 13.0), ('beta', 13.0, 30.0)] # name, min Hz, max Hz
+SYNC_BACKEND = 'spread' # spread = how little channels' amp and freq differ; correlation = mean absolute correlation of every pair of channels; coherence = mean magnitude-squared coherence of every pair of channels within BANDS. Either pairwise backend also gives each channel the sync of its region, which channel rules test
+SYNC_SEGMENT_MS = 1000 # length of the half-overlapping segments coherence is estimated from; overlapping measures use their blocks
+REGIONS = [('frontal', ['Fp1','Fp2','F3','F4','F7','F8','Fz']), ('central', ['C3','C4','Cz']), ('parietal', ['P3','P4','Pz']),
+           ('occipital', ['O1','O2','Oz']), ('temporal', ['T1','T2','T3','T4','T5','T6']), ('ear', ['A1','A2'])] # channels in no region get the sync of all channels
+LABELS = eegio.LABELS # channels to read, in order
 
 # Files
 INSTRUMENTS_INPUT_FILE = 'data/instruments.csv'
@@ -32,34 +60,72 @@ REPORT_SUMMARY_CHANNEL_OUTPUT_FILE = 'data/report_channel_summary.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+SEQUENCE_BINARY_OUTPUT_FILE = 'data/ck_sequence.bin'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/eeg.json'
+RUN_REPORT_OUTPUT_FILE = 'data/report_run.json'
+PROFILE_OUTPUT_FILE = 'data/report_run.prof'
 INSTRUMENTS_DIR = 'instruments/'
 
+# Input options
+EEG_INPUT_FORMAT = 'csv' # csv = read EEG_INPUT_FILE as written by edf2csv.py, eeg = memory-map EEG_BINARY_INPUT_FILE, edf = stream samples straight from EDF_INPUT_FILE
+EEG_BINARY_INPUT_FILE = 'output/GUICHARD_081217.eeg'
+EDF_INPUT_FILE = 'data/GUICHARD 081217.edf'
+EDF_START_S = 21195
+EDF_END_S = 21455
+EDF_CHUNK_S = 60 # seconds of samples to read from the .edf at a time
+EEG_DIGITAL = False # edf only: keep the .edf's int16 digital samples, scaled to physical values only as features are calculated; .eeg files written with edf2csv.py's DIGITAL always are
+
+# Stream options
+STREAM_WINDOW = 0 # number of recent measures that streamed measures are normalized against; 0 = all measures so far
+
+# Cache options
+CACHE_DIR = 'output/cache/' # each stage's output is saved here under a hash of its inputs, so a rerun only recalculates the stages affected by a change; '' = don't cache
+CACHE_MAX_MB = 1024 # least recently used files in CACHE_DIR are deleted to keep it under this
+CACHE_BATCH = 4096 # number of streamed items, e.g. sequence events, to append to a cache file at a time
+
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'text' # text = SEQUENCE_OUTPUT_FILE, one value per line; binary = SEQUENCE_BINARY_OUTPUT_FILE, read by brant.ck when binary_sequence is 1
 WRITE_REPORT = True
 WRITE_JSON = False
+WRITE_RUN_REPORT = True # wall time and peak memory of each stage, and counts of what it processed, as JSON
+PROFILE = False # profile the run with cProfile into PROFILE_OUTPUT_FILE, e.g. for python -m pstats
 
 # Calculations
-BEAT_MS = round(60.0 / BPM * 1000)
-MEASURE_MS = BEAT_MS * 4.0
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
-CHANNEL_COUNT = len(LABELS)
 RANGE = [-100, 100]
+# Binary sequence: an int32 count of events followed by a fixed-width record per event
+SEQUENCE_BINARY_DTYPE = [('index', '<i4'), ('position', '<i4'), ('gain', '<f4'), ('rate', '<f4'), ('milliseconds', '<i4')]
+SEQUENCE_BINARY_BATCH = 4096 # number of binary records to write at a time
 
-print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
+# Settings above that can be overridden per run
+CONFIG_KEYS = ['BPM', 'DIVISIONS_PER_BEAT', 'VARIANCE_MS', 'JITTER', 'GAIN', 'TEMPO', 'MEASURE_BATCH', 'MEASURE_HOP_BEATS',
+               'FREQUENCY_BACKEND', 'BANDS', 'SYNC_BACKEND', 'SYNC_SEGMENT_MS', 'REGIONS', 'LABELS', 'RANGE', 'INSTRUMENTS_INPUT_FILE', 'EEG_INPUT_FILE', 'REPORT_SUMMARY_OUTPUT_FILE',
+               'REPORT_SUMMARY_CHANNEL_OUTPUT_FILE', 'REPORT_SEQUENCE_OUTPUT_FILE', 'INSTRUMENTS_OUTPUT_FILE',
+               'SEQUENCE_OUTPUT_FILE', 'SEQUENCE_BINARY_OUTPUT_FILE', 'VISUALIZATION_OUTPUT_FILE', 'INSTRUMENTS_DIR',
+               'EEG_INPUT_FORMAT', 'EEG_BINARY_INPUT_FILE', 'EDF_INPUT_FILE', 'EDF_START_S', 'EDF_END_S', 'EDF_CHUNK_S',
+               'EEG_DIGITAL', 'STREAM_WINDOW', 'CACHE_DIR', 'CACHE_MAX_MB', 'CACHE_BATCH', 'WRITE_SEQUENCE', 'SEQUENCE_FORMAT', 'WRITE_REPORT', 'WRITE_JSON',
+               'RUN_REPORT_OUTPUT_FILE', 'PROFILE_OUTPUT_FILE', 'WRITE_RUN_REPORT', 'PROFILE', 'SEQUENCE_BINARY_BATCH']
+OUTPUT_KEYS = ['REPORT_SUMMARY_OUTPUT_FILE', 'REPORT_SUMMARY_CHANNEL_OUTPUT_FILE', 'REPORT_SEQUENCE_OUTPUT_FILE',
+               'INSTRUMENTS_OUTPUT_FILE', 'SEQUENCE_OUTPUT_FILE', 'SEQUENCE_BINARY_OUTPUT_FILE', 'VISUALIZATION_OUTPUT_FILE',
+               'RUN_REPORT_OUTPUT_FILE', 'PROFILE_OUTPUT_FILE']
 
-# Initialize Variables
-instruments = []
-eeg = []
-eeg_min = []
-eeg_max = []
-measures = []
-abs_min = 0
-abs_max = 0
-sequence = []
-hindex = 0
-total_ms = 0
+# Returns a config dict of the settings above with any overrides, plus the values calculated from them
+def getConfig(**overrides):
+  config = dict((key, globals()[key]) for key in CONFIG_KEYS)
+  for key in overrides:
+    if key not in CONFIG_KEYS:
+      raise KeyError('Unknown config key: ' + key)
+    config[key] = overrides[key]
+  config['BEAT_MS'] = round(60.0 / config['BPM'] * 1000)
+  config['MEASURE_MS'] = config['BEAT_MS'] * 4.0
+  config['HOP_MS'] = config['MEASURE_MS']
+  if config['MEASURE_HOP_BEATS'] > 0:
+    if (4.0 / config['MEASURE_HOP_BEATS']) % 1 != 0:
+      raise ValueError('MEASURE_HOP_BEATS must divide the 4 beats of a measure: ' + str(config['MEASURE_HOP_BEATS']))
+    config['HOP_MS'] = config['BEAT_MS'] * config['MEASURE_HOP_BEATS']
+  config['ROUND_TO_NEAREST'] = round(config['BEAT_MS']/config['DIVISIONS_PER_BEAT'])
+  config['CHANNEL_COUNT'] = len(config['LABELS'])
+  return config
 
 # For creating pseudo-random numbers
 def halton(index, base):
@@ -113,47 +179,57 @@ def findInList(list, key, value):
 def roundToNearest(n, nearest):
   return 1.0 * round(1.0*n/nearest) * nearest
 
-# Read instruments from file
-with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-  r = csv.reader(f, delimiter=',')
-  next(r, None) # remove header
-  for name,channel,amp_min,amp_max,freq_min,freq_max,sync_min,sync_max,filename,from_gain,to_gain,tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
-    if int(active):
-      index = len(instruments)
-      # build instrument object
-      instrument = {
-        'index': index,
-        'name': name,
-        'channel': channel,
-        'amp_min': float(amp_min),
-        'amp_max': float(amp_max),
-        'freq_min': float(freq_min),
-        'freq_max': float(freq_max),
-        'sync_min': float(sync_min),
-        'sync_max': float(sync_max),
-        'file': INSTRUMENTS_DIR + filename,
-        'from_gain': float(from_gain),
-        'to_gain': float(to_gain),
-        'tempo': float(tempo),
-        'tempo_offset': float(tempo_offset),
-        'interval_ms': int(int(interval_phase)*BEAT_MS),
-        'interval': int(interval),
-        'interval_offset': int(interval_offset)
-      }
-      # add instrument to instruments
-      instruments.append(instrument)
+# Read instruments from file; inactive ones are left out unless include_inactive
+def readInstruments(config, include_inactive=False):
+  instruments = []
+  with open(config['INSTRUMENTS_INPUT_FILE'], 'rb') as f:
+    r = csv.DictReader(f, delimiter=',', skipinitialspace=True)
+    for row in r:
+      if int(row['Active']) or include_inactive:
+        index = len(instruments)
+        # build instrument object
+        instrument = {
+          'index': index,
+          'name': row['Name'],
+          'channel': row['Channel'],
+          'amp_min': float(row['Amp Min']),
+          'amp_max': float(row['Amp Max']),
+          'freq_min': float(row['Freq Min']),
+          'freq_max': float(row['Freq Max']),
+          'sync_min': float(row['Sync Min']),
+          'sync_max': float(row['Sync Max']),
+          'file': config['INSTRUMENTS_DIR'] + row['File'],
+          'from_gain': float(row['Gain From']),
+          'to_gain': float(row['Gain To']),
+          'tempo': float(row['Tempo']),
+          'tempo_offset': float(row['Tempo Offset']),
+          'interval_ms': int(int(row['Interval Phase'])*config['BEAT_MS']),
+          'interval': int(row['Interval']),
+          'interval_offset': int(row['Interval Offset']),
+          'active': int(row['Active'])
+        }
+        # band power ranges; files from before band powers have none, so they match everything
+        for band, low, high in config['BANDS']:
+          instrument[band+'_min'] = float(row.get(band.title()+' Min') or 0)
+          instrument[band+'_max'] = float(row.get(band.title()+' Max') or 2)
+        # add instrument to instruments
+        instruments.append(instrument)
+  return instruments
 
 # Count the number of waves in a given list of values
 def getFrequency(data, _min, _max, _stdev):
+  data = np.asarray(data)
   waves = 0.0
   threshold = _stdev / 2.0
   last_peak_value = None
-  for i, value in enumerate(data):
-    if i > 0 and i < len(data)-1:
-      # Look for a peak that has a value that is more than a {threshold} than the last peak value
-      if (value > data[i-1] and value > data[i+1] or value < data[i-1] and value < data[i+1]) and (last_peak_value is None or abs(value-last_peak_value) > threshold):
-        last_peak_value = value
-        waves += 1
+  # Candidate peaks are the local maxima and minima
+  prev_values, values, next_values = data[:-2], data[1:-1], data[2:]
+  peaks = values[(values > prev_values) & (values > next_values) | (values < prev_values) & (values < next_values)]
+  for value in peaks.tolist():
+    # Look for a peak that has a value that is more than a {threshold} than the last peak value
+    if last_peak_value is None or abs(value-last_peak_value) > threshold:
+      last_peak_value = value
+      waves += 1
   # wave(s) found
   return waves
 
@@ -172,6 +248,14 @@ def parseNumber(string):
     except ValueError:
         return string
 
+# Parses a value given on the command line as a Python literal, e.g. 100, False or [-50, 50]; anything else, e.g.
+# a path, is kept as a string
+def parseSetting(string):
+    try:
+        return ast.literal_eval(string)
+    except (ValueError, SyntaxError):
+        return string
+
 def parseRows(arr):
     for i, item in enumerate(arr):
         for key in item:
@@ -188,315 +272,1317 @@ def readCSV(filename):
             rows = parseRows(rows)
     return rows
 
-eegData = readCSV(EEG_INPUT_FILE)
-last_ms = 0
-measure = []
-next_measure = MEASURE_MS
-
-# normalize data
-for i,d in enumerate(eegData):
-    for l in LABELS:
-        val = eegData[i][l]
-        eegData[i][l] = norm(val, RANGE[0], RANGE[1])
-
-for d in eegData:
-    ms = d['Time']
-    if ms >= next_measure:
-      measures.append({
-        "readings": measure,
-        "channels": [],
-        "duration": MEASURE_MS
-      })
-      measure = []
-      next_measure += MEASURE_MS
+# Normalize an array of readings to between 0 and 1, same as norm(). With the (gains, offsets) of readScale(),
+# readings are digital values, scaled to physical values in the same pass
+def normReadings(config, readings, scale=None):
+    _range = config['RANGE']
+    width = 1.0 * (_range[1] - _range[0])
+    if scale is None:
+        readings = (np.asarray(readings, dtype=float) - _range[0]) / width
     else:
-      measure.append([d[l] for l in LABELS])
-    total_ms += (ms - last_ms)
-    last_ms = ms
+        gains, offsets = scale
+        readings = np.asarray(readings) * (gains / width) + (offsets - _range[0]) / width
+    return readings.clip(0, 1)
 
-# Add the last measure
-if len(measure) > 0:
-    measures.append({
-      "readings": measure,
-      "channels": [],
-      "duration": total_ms - MEASURE_MS * len(measures)
-    })
+# Returns the (gains, offsets) of each of LABELS that scale the configured input's readings to physical values if
+# they are digital values, i.e. an .edf read with EEG_DIGITAL or an .eeg written with them; otherwise None
+def readScale(config):
+    if config['EEG_INPUT_FORMAT'] == 'edf' and config['EEG_DIGITAL']:
+        f, channels, samplesPerSecond = eegio.openEdf(config['EDF_INPUT_FILE'], config['LABELS'])
+        try:
+            return eegio.getScale(f, channels)
+        finally:
+            f._close()
+    if config['EEG_INPUT_FORMAT'] == 'eeg':
+        header = eegio.readEegHeader(config['EEG_BINARY_INPUT_FILE'])
+        if 'gains' in header:
+            channels = [header['labels'].index(l) for l in config['LABELS']]
+            return np.array(header['gains'])[channels], np.array(header['offsets'])[channels]
+    return None
+
+# Yields (ms, readings) arrays for a .csv written by edf2csv.py
+def readCSVReadings(config, filename):
+    rows = readCSV(filename)
+    times = np.array([d['Time'] for d in rows], dtype=int)
+    readings = np.array([[d[l] for l in config['LABELS']] for d in rows], dtype=float).reshape(-1, config['CHANNEL_COUNT'])
+    yield times, readings
+
+# Yields (ms, readings) arrays for an .eeg written by edf2csv.py; readings are memory-mapped, not read into memory
+def readEEGReadings(config, filename):
+    header, readings = eegio.readEegFile(filename)
+    channels = [header['labels'].index(l) for l in config['LABELS']]
+    if channels != list(range(len(header['labels']))):
+        # select channels as measures are read rather than copying the whole file
+        readings = eegio.ChannelView(readings, channels)
+    yield eegio.getTimes(0, len(readings), header['sample_rate']), readings
+
+# Yields (ms, readings) arrays for an .edf, read in bounded chunks into one array the size of the window; readings
+# are int16 digital values if EEG_DIGITAL
+def readEDFReadings(config, filename):
+    yield eegio.readEdf(filename, config['LABELS'], config['EDF_START_S'], config['EDF_END_S'], config['EDF_CHUNK_S'], config['EEG_DIGITAL'])
+
+# Returns (ms, readings) arrays of the configured EEG input. Readings are kept as read (e.g. memory-mapped) and
+# only normalized per batch of measures; see readScale() for whether they are digital values
+def readEEG(config):
+    if config['EEG_INPUT_FORMAT'] == 'edf':
+        eegReadings = readEDFReadings(config, config['EDF_INPUT_FILE'])
+    elif config['EEG_INPUT_FORMAT'] == 'eeg':
+        eegReadings = readEEGReadings(config, config['EEG_BINARY_INPUT_FILE'])
+    else:
+        eegReadings = readCSVReadings(config, config['EEG_INPUT_FILE'])
+    chunks = list(eegReadings)
+    if len(chunks) == 1:
+        return chunks[0]
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=int), np.zeros((0, config['CHANNEL_COUNT']))
+    eeg_times = np.concatenate([times for times, readings in chunks])
+    eeg_readings = np.concatenate([readings for times, readings in chunks])
+    return eeg_times, eeg_readings
+
+# Samples per second of readings, from their ms timestamps
+def getSampleRate(times):
+    if len(times) < 2 or times[-1] <= times[0]:
+        return 0
+    return 1000.0 * (len(times) - 1) / (times[-1] - times[0])
+
+# Split readings into measures of MEASURE_MS; the sample that crosses each measure boundary is skipped
+def getMeasures(config, times, readings):
+    _measures = []
+    measure_ms = config['MEASURE_MS']
+    measureIndexes = (times // measure_ms).astype(int)
+    boundaries = (np.flatnonzero(np.diff(measureIndexes)) + 1).tolist()
+    start = 0
+    for boundary in boundaries:
+        _measures.append({
+            "readings": readings[start:boundary],
+            "channels": [],
+            "duration": measure_ms
+        })
+        start = boundary + 1
+    # Add the last measure
+    if start < len(readings):
+        _measures.append({
+            "readings": readings[start:],
+            "channels": [],
+            "duration": int(times[-1]) - measure_ms * len(_measures)
+        })
+    return _measures
+
+# Absolute correlation of every pair of channels, from (... x channels x channels) covariances
+def getCorrelations(cov):
+  stdevs = np.sqrt(np.maximum(np.diagonal(cov, axis1=-2, axis2=-1), 0))
+  denom = stdevs[..., :, np.newaxis] * stdevs[..., np.newaxis, :]
+  return np.where(denom > 0, np.abs(cov) / np.where(denom > 0, denom, 1), 0)
+
+# (... x frequencies x channels x channels) cross spectra of (... x segments x frequencies x channels) spectra, summed
+# over the segments
+def getCrossSpectra(spectra):
+  spectra = np.swapaxes(np.swapaxes(spectra, -3, -2), -2, -1)
+  return np.matmul(spectra.conj(), np.swapaxes(spectra, -2, -1))
+
+# Magnitude-squared coherence of every pair of channels, from (... x frequencies x channels x channels) cross spectra,
+# averaged over the frequencies
+def getCoherences(cross):
+  auto = np.real(np.diagonal(cross, axis1=-2, axis2=-1))
+  denom = auto[..., :, np.newaxis] * auto[..., np.newaxis, :]
+  coherences = np.where(denom > 0, np.abs(cross) ** 2 / np.where(denom > 0, denom, 1), 0)
+  return coherences.mean(axis=-3)
+
+# Pairwise sync of the channels of a batch of measures, given their readings less their means as a (measures x samples
+# x channels) array that is 0 past each measure's length; returns a (measures x channels x channels) array. Coherence
+# is estimated with Welch's method, from segments of SYNC_SEGMENT_MS that overlap by half, leaving out those past the
+# end of a measure; it is NaN for measures with only one segment, which is always fully coherent
+def getSyncMatrices(config, d, lengths, sample_rate):
+  if config['SYNC_BACKEND'] == 'correlation':
+    return getCorrelations(np.matmul(np.swapaxes(d, 1, 2), d))
+  bands = config['BANDS']
+  length = min(max(int(round(config['SYNC_SEGMENT_MS'] * sample_rate / 1000.0)), 2), d.shape[1])
+  segment_starts = np.arange(0, d.shape[1] - length + 1, max(length // 2, 1))
+  segments = d[:, segment_starts[:, np.newaxis] + np.arange(length)]
+  used = (segment_starts + length <= lengths[:, np.newaxis]) | (segment_starts == 0)
+  hz = np.fft.rfftfreq(length, 1.0 / sample_rate)
+  in_bands = (hz >= bands[0][1]) & (hz < bands[-1][2])
+  spectra = np.fft.rfft(segments * np.hanning(length)[:, np.newaxis], axis=2)[:, :, in_bands]
+  matrices = getCoherences(getCrossSpectra(spectra * used[:, :, np.newaxis, np.newaxis]))
+  matrices[used.sum(axis=1) < 2] = np.nan
+  return matrices
+
+# Hann windows over each of lengths samples, padded with zeros to length, so padded readings are each windowed over
+# their own samples; returns a (len(lengths) x length x 1) array
+def getWindows(lengths, length):
+  windows = np.zeros((len(lengths), length))
+  for i, n in enumerate(lengths):
+    windows[i, :n] = np.hanning(n)
+  return windows[:, :, np.newaxis]
+
+# Returns (name, channel indexes) of the REGIONS with at least 2 of LABELS
+def getRegions(config):
+  labels = config['LABELS']
+  regions = []
+  for name, region_labels in config['REGIONS']:
+    channels = [labels.index(label) for label in region_labels if label in labels]
+    if len(channels) > 1:
+      regions.append((name, channels))
+  return regions
+
+# Reduces pairwise sync matrices to (sync of all pairs of channels of each measure, sync of the pairs in each
+# channel's region of each measure)
+def reduceSync(config, matrices):
+  channel_count = matrices.shape[-1]
+  pairs = np.triu(np.ones((channel_count, channel_count), dtype=bool), 1)
+  syncs = matrices[:, pairs].mean(axis=1)
+  region_syncs = np.repeat(syncs[:, np.newaxis], channel_count, axis=1)
+  for name, channels in getRegions(config):
+    in_region = np.zeros(channel_count, dtype=bool)
+    in_region[channels] = True
+    region_syncs[:, in_region] = matrices[:, pairs & np.outer(in_region, in_region)].mean(axis=1)[:, np.newaxis]
+  return syncs, region_syncs
+
+# Measures without a sync (see getSyncMatrices()) get the sync of the measure before them
+def fillSync(features):
+  for key in ['sync', 'region_sync']:
+    values = features[key]
+    missing = np.isnan(values if values.ndim == 1 else values[:, 0])
+    for mindex in np.flatnonzero(missing).tolist():
+      values[mindex] = values[mindex - 1] if mindex > 0 else 0
+
+# Calculate stdev, max, frequency and relative band power of each channel of each measure; returns a dict of
+# (measures x channels) arrays. Measures are padded into a (measures x samples x channels) array, MEASURE_BATCH
+# measures at a time, so each feature is computed for the whole batch at once. Every batch is padded to the longest
+# measure, so a measure's spectrum doesn't depend on the batch it is in. With a pairwise SYNC_BACKEND, also
+# returns the (measures) sync and (measures x channels) region_sync of reduceSync(). scale is that of readScale()
+def getMeasureFeatures(config, _measures, sample_rate, scale=None):
+  count = len(_measures)
+  bands = config['BANDS']
+  channel_count = config['CHANNEL_COUNT']
+  measure_batch = config['MEASURE_BATCH']
+  features = {}
+  for key in ['amp', 'max', 'freq'] + [band for band, low, high in bands]:
+    features[key] = np.zeros((count, channel_count))
+  pairwise = config['SYNC_BACKEND'] != 'spread'
+  if pairwise:
+    features['sync'] = np.zeros(count)
+    features['region_sync'] = np.zeros((count, channel_count))
+  fft_length = max([len(measure["readings"]) for measure in _measures] + [1])
+  for b0 in range(0, count, measure_batch):
+    batch = _measures[b0:b0+measure_batch]
+    b1 = b0 + len(batch)
+    lengths = np.array([len(measure["readings"]) for measure in batch])
+    data = np.zeros((len(batch), fft_length, channel_count))
+    for i, measure in enumerate(batch):
+      data[i, :lengths[i]] = normReadings(config, measure["readings"], scale)
+    mask = (np.arange(data.shape[1]) < lengths[:, np.newaxis])[:, :, np.newaxis]
+    n = 1.0 * lengths[:, np.newaxis]
+    # Two-pass variance, same as variance()
+    c = data.sum(axis=1) / n
+    d = np.where(mask, data - c[:, np.newaxis, :], 0)
+    ss = (d ** 2).sum(axis=1) - d.sum(axis=1) ** 2 / n
+    amps = np.sqrt(np.maximum(ss / n, 0))
+    features['amp'][b0:b1] = amps
+    features['max'][b0:b1] = np.where(mask, data, -np.inf).max(axis=1)
+    if pairwise:
+      features['sync'][b0:b1], features['region_sync'][b0:b1] = reduceSync(config, getSyncMatrices(config, d, lengths, sample_rate))
+    # Power spectrum of every channel of every measure
+    power = np.abs(np.fft.rfft(d * getWindows(lengths, fft_length), axis=1)) ** 2
+    hz = np.fft.rfftfreq(data.shape[1], 1.0 / sample_rate)
+    in_bands = (hz >= bands[0][1]) & (hz < bands[-1][2])
+    total_power = power[:, in_bands].sum(axis=1)
+    total_power[total_power <= 0] = 1.0
+    for band, low, high in bands:
+      in_band = (hz >= low) & (hz < high)
+      features[band][b0:b1] = power[:, in_band].sum(axis=1) / total_power
+    if config['FREQUENCY_BACKEND'] == 'spectral':
+      # Dominant frequency within the range of BANDS
+      features['freq'][b0:b1] = hz[in_bands][power[:, in_bands].argmax(axis=1)]
+    else:
+      for i, measure in enumerate(batch):
+        for cindex in range(channel_count):
+          features['freq'][b0+i, cindex] = getFrequency(data[i, :lengths[i], cindex], None, None, amps[i, cindex])
+  if pairwise:
+    fillSync(features)
+  return features
+
+# Calculate the same features as getMeasureFeatures() for overlapping measures of MEASURE_MS that start every HOP_MS.
+# The readings are split into blocks of HOP_MS and every sample is only read once: each block's sums, max, wave count
+# and band powers are calculated, then each measure's are the sums of its blocks', taken from running sums over the
+# blocks. Band powers are averaged over the blocks of a measure (as in Welch's method) and waves are counted per block,
+# so they differ slightly from a measure's own. Pairwise sync is calculated from the sums of the blocks' cross
+# products (correlation) or cross spectra (coherence, with the blocks as its segments). Every block starts a measure;
+# the last measures have fewer blocks. Returns (duration of each measure, features), where durations are HOP_MS, the
+# time each measure plays for
+def getWindowFeatures(config, times, readings, scale=None):
+  hop_ms = config['HOP_MS']
+  blocks_per_measure = int(round(config['MEASURE_MS'] / hop_ms))
+  bands = config['BANDS']
+  channel_count = config['CHANNEL_COUNT']
+  measure_batch = config['MEASURE_BATCH']
+  sample_rate = getSampleRate(times)
+  block_indexes = (times // hop_ms).astype(int)
+  starts = np.concatenate(([0], np.flatnonzero(np.diff(block_indexes)) + 1)) if len(times) > 0 else np.zeros(0, dtype=int)
+  ends = np.append(starts[1:], len(times))
+  count = len(starts)
+  features = {}
+  for key in ['amp', 'max', 'freq'] + [band for band, low, high in bands]:
+    features[key] = np.zeros((count, channel_count))
+  if count < 1:
+    return [], features
+
+  # Each measure's blocks are [first, last)
+  first = np.arange(count)
+  last = np.minimum(first + blocks_per_measure, count)
+  def sumBlocks(values):
+    running = np.concatenate((np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)))
+    return running[last] - running[first]
+
+  # Sums and max of every block, MEASURE_BATCH blocks at a time. Sums are of readings less the first block's mean,
+  # so the squares don't lose precision
+  shift = normReadings(config, readings[starts[0]:ends[0]], scale).mean(axis=0)
+  block_sums = np.zeros((count, channel_count))
+  block_squares = np.zeros((count, channel_count))
+  block_maxs = np.zeros((count, channel_count))
+  for b0 in range(0, count, measure_batch):
+    b1 = min(b0 + measure_batch, count)
+    data = normReadings(config, readings[starts[b0]:ends[b1-1]], scale) - shift
+    offsets = starts[b0:b1] - starts[b0]
+    block_sums[b0:b1] = np.add.reduceat(data, offsets, axis=0)
+    block_squares[b0:b1] = np.add.reduceat(data ** 2, offsets, axis=0)
+    block_maxs[b0:b1] = np.maximum.reduceat(data, offsets, axis=0) + shift
+  block_n = 1.0 * (ends - starts)[:, np.newaxis]
+  n = sumBlocks(block_n)
+  sums = sumBlocks(block_sums)
+  amps = np.sqrt(np.maximum((sumBlocks(block_squares) - sums ** 2 / n) / n, 0))
+  features['amp'] = amps
+  maxs = block_maxs[first]
+  for k in range(1, blocks_per_measure):
+    maxs = np.maximum(maxs, block_maxs[np.minimum(first + k, last - 1)])
+  features['max'] = maxs
+
+  # Power spectrum and wave count of every block, padded to the same length so they have the same frequencies.
+  # Waves are counted with the stdev of the measure the block is in the middle of as the threshold
+  fft_length = int((ends - starts).max())
+  hz = np.fft.rfftfreq(fft_length, 1.0 / sample_rate)
+  in_bands = (hz >= bands[0][1]) & (hz < bands[-1][2])
+  thresholds = amps[np.maximum(first - blocks_per_measure // 2, 0)]
+  block_powers = dict((band, np.zeros((count, channel_count))) for band, low, high in bands)
+  block_total_power = np.zeros((count, channel_count))
+  block_spectra = np.zeros((count, in_bands.sum(), channel_count)) if config['FREQUENCY_BACKEND'] == 'spectral' else None
+  block_waves = np.zeros((count, channel_count))
+  pairwise = config['SYNC_BACKEND'] != 'spread'
+  if pairwise:
+    features['sync'] = np.zeros(count)
+    features['region_sync'] = np.zeros((count, channel_count))
+  # Cross products or spectra of the blocks of the previous batch that measures of this batch include
+  carry = None
+  for b0 in range(0, count, measure_batch):
+    b1 = min(b0 + measure_batch, count)
+    lengths = ends[b0:b1] - starts[b0:b1]
+    data = np.zeros((b1 - b0, fft_length, channel_count))
+    for i in range(b1 - b0):
+      data[i, :lengths[i]] = normReadings(config, readings[starts[b0+i]:ends[b0+i]], scale)
+    mask = (np.arange(fft_length) < lengths[:, np.newaxis])[:, :, np.newaxis]
+    d = np.where(mask, data - (data.sum(axis=1) / lengths[:, np.newaxis])[:, np.newaxis, :], 0)
+    spectra = np.fft.rfft(d * getWindows(lengths, fft_length), axis=1)
+    power = np.abs(spectra) ** 2
+    block_total_power[b0:b1] = power[:, in_bands].sum(axis=1)
+    for band, low, high in bands:
+      block_powers[band][b0:b1] = power[:, (hz >= low) & (hz < high)].sum(axis=1)
+    if block_spectra is not None:
+      block_spectra[b0:b1] = power[:, in_bands]
+    else:
+      for i in range(b1 - b0):
+        for cindex in range(channel_count):
+          block_waves[b0+i, cindex] = getFrequency(data[i, :lengths[i], cindex], None, None, thresholds[b0+i, cindex])
+    if pairwise:
+      if config['SYNC_BACKEND'] == 'correlation':
+        shifted = np.where(mask, data - shift, 0)
+        cross = np.matmul(np.swapaxes(shifted, 1, 2), shifted)
+      else:
+        cross = getCrossSpectra(spectra[:, np.newaxis, in_bands])
+      if carry is not None:
+        cross = np.concatenate((carry, cross))
+      # Measures whose last block is in this batch, which are all the rest in the last batch
+      c0 = b1 - len(cross)
+      m0 = max(b0 - blocks_per_measure + 1, 0)
+      m1 = b1 - blocks_per_measure + 1 if b1 < count else count
+      if m1 > m0:
+        running = np.concatenate((np.zeros((1,) + cross.shape[1:], dtype=cross.dtype), np.cumsum(cross, axis=0)))
+        measure_cross = running[last[m0:m1] - c0] - running[first[m0:m1] - c0]
+        if config['SYNC_BACKEND'] == 'correlation':
+          _n = n[m0:m1, 0, np.newaxis, np.newaxis]
+          _sums = sums[m0:m1]
+          matrices = getCorrelations(measure_cross / _n - _sums[:, :, np.newaxis] * _sums[:, np.newaxis, :] / _n ** 2)
+        else:
+          matrices = getCoherences(measure_cross)
+          matrices[last[m0:m1] - first[m0:m1] < 2] = np.nan
+        features['sync'][m0:m1], features['region_sync'][m0:m1] = reduceSync(config, matrices)
+      carry = cross[max(len(cross) - blocks_per_measure + 1, 0):] if blocks_per_measure > 1 else None
+
+  total_power = sumBlocks(block_total_power)
+  total_power[total_power <= 0] = 1.0
+  for band, low, high in bands:
+    features[band] = sumBlocks(block_powers[band]) / total_power
+  if block_spectra is not None:
+    features['freq'] = hz[in_bands][sumBlocks(block_spectra).argmax(axis=1)]
+  else:
+    features['freq'] = sumBlocks(block_waves)
+  if pairwise:
+    fillSync(features)
+
+  durations = [hop_ms] * (count - 1) + [int(times[-1]) - hop_ms * (count - 1)]
+  return durations, features
+
+# Returns (duration of each measure, features of each measure) of readings, split into measures of MEASURE_MS by
+# getMeasures(), or into overlapping measures by getWindowFeatures() if they start every HOP_MS. scale is that of
+# readScale()
+def getFeatures(config, times, readings, report=None, scale=None):
+  if config['HOP_MS'] < config['MEASURE_MS']:
+    return timeStage(report, 'measure_features', lambda: getWindowFeatures(config, times, readings, scale))
+  _measures = timeStage(report, 'measures', lambda: getMeasures(config, times, readings))
+  features = timeStage(report, 'measure_features', lambda: getMeasureFeatures(config, _measures, getSampleRate(times), scale))
+  return [measure['duration'] for measure in _measures], features
+
+# Normalize features over all measures; returns a dict of the values instruments are matched against: (measures x
+# channels) arrays of amp, max, freq and band powers, and (measures) arrays of mean_amp, mean_freq, sync and mean
+# band powers, plus (measures x channels) region_sync with a pairwise SYNC_BACKEND
+def normalizeFeatures(config, features):
+  amps, maxs, freqs = features['amp'], features['max'], features['freq']
+  mean_amps = amps.mean(axis=1)
+  mean_freqs = freqs.mean(axis=1)
+  syncs = (amps.std(axis=1) + freqs.std(axis=1)) / 2.0
+  if 'sync' in features:
+    # less spread is more sync, more pairwise sync is
+    syncs = -features['sync']
+
+  # Keep track of min/max stdev for normalization
+  min_amp, max_amp = amps.min(), amps.max()
+  min_mean_amp, max_mean_amp = mean_amps.min(), mean_amps.max()
+  min_freq, max_freq = freqs.min(), freqs.max()
+  min_mean_freq, max_mean_freq = mean_freqs.min(), mean_freqs.max()
+  min_sync, max_sync = syncs.min(), syncs.max()
 
-# Report EEG data
-print('Retrieved EEG data with '+ str(len(LABELS)) + ' channels')
-print(str(len(measures)) + ' total measures created, ' + str(MEASURE_MS) + 'ms each')
-
-# Keep track of min/max stdev for normalization
-min_amp = None
-max_amp = None
-min_mean_amp = None
-max_mean_amp = None
-min_freq = None
-max_freq = None
-min_mean_freq = None
-max_mean_freq = None
-min_sync = None
-max_sync = None
-
-# Go through each measure
-for mindex, measure in enumerate(measures):
-  channels = []
-  amps = []
-  maxs = []
-  freqs = []
-  # Create an array of channel-value arrays
-  for channel in range(CHANNEL_COUNT):
-    channels.append([])
-  for reading in measure["readings"]:
-    for channel, value in enumerate(reading):
-      channels[channel].append(value)
-  # For each channel
-  for cindex, channel in enumerate(channels):
-    # Calculate stdev, min/max, freq
-    _stdev = stdev(channel)
-    _min = min(channel)
-    _max = max(channel)
-    _freq = getFrequency(channel, _min, _max, _stdev)
-    amps.append(_stdev)
-    freqs.append(_freq)
-    maxs.append(_max)
-    # Keep track of max/mins
-    if _stdev > max_amp or max_amp is None:
-      max_amp = _stdev
-    if _stdev < min_amp or min_amp is None:
-      min_amp = _stdev
-    if _freq > max_freq or max_freq is None:
-      max_freq = _freq
-    if _freq < min_freq or min_freq is None:
-      min_freq = _freq
-    # Add to channel list to measure
-    measures[mindex]["channels"].append({
-      "index": cindex,
-      "name": LABELS[cindex],
-      "amp": _stdev,
-      "max": _max,
-      "freq": _freq
-    })
-  # Calculate max/means/stdevs
-  mean_amp = mean(amps)
-  sync = (stdev(amps) + stdev(freqs))/2.0
-  mean_freq = mean(freqs)
-  measures[mindex]["max"] = max(maxs)
-  measures[mindex]["mean_amp"] = mean_amp
-  measures[mindex]["mean_freq"] = mean_freq
-  measures[mindex]["sync"] = sync
-  # Keep track of min/max
-  if mean_amp > max_mean_amp or max_mean_amp is None:
-    max_mean_amp = mean_amp
-  if mean_amp < min_mean_amp or min_mean_amp is None:
-    min_mean_amp = mean_amp
-  if mean_freq > max_mean_freq or max_mean_freq is None:
-    max_mean_freq = mean_freq
-  if mean_freq < min_mean_freq or min_mean_freq is None:
-    min_mean_freq = mean_freq
-  if sync > max_sync or max_sync is None:
-    max_sync = sync
-  if sync < min_sync or min_sync is None:
-    min_sync = sync
-
-# Normalize all values in measures
-for mindex, measure in enumerate(measures):
-  amp_delta = max_amp - min_amp
-  amp_mean_delta = max_mean_amp - min_mean_amp
-  freq_delta = max_freq - min_freq
-  freq_mean_delta = max_mean_freq - min_mean_freq
-  sync_delta = max_sync - min_sync
   # Normalize all values to between 0 and 1
-  measures[mindex]["mean_amp"] = 1.0 * (measure["mean_amp"]-min_mean_amp) / amp_mean_delta
-  measures[mindex]["mean_freq"] = 1.0 * (measure["mean_freq"]-min_mean_freq) / freq_mean_delta
-  measures[mindex]["sync"] = 1.0 - 1.0 * (measure["sync"]-min_sync) / sync_delta
-  # measures[mindex]["gain"] = measures[mindex]["mean_amp"] * (MAX_GAIN-MIN_GAIN) + MIN_GAIN
-  for cindex, channel in enumerate(measure["channels"]):
-    measures[mindex]["channels"][cindex]["amp"] = 1.0 * (channel["amp"]-min_amp) / amp_delta
-    measures[mindex]["channels"][cindex]["freq"] = 1.0 * (channel["freq"]-min_freq) / freq_delta
-
-# Returns list of valid instruments given measure data
-def getInstruments(_instruments, _measure):
-  valid_instruments = []
-  for instrument in _instruments:
-    if instrument["channel"]=="all" and _measure["mean_amp"]>=instrument["amp_min"] and _measure["mean_amp"]<instrument["amp_max"] and _measure["mean_freq"]>=instrument["freq_min"] and _measure["mean_freq"]<instrument["freq_max"] and _measure["sync"]>=instrument["sync_min"] and _measure["sync"]<instrument["sync_max"]:
-      _instrument = instrument.copy()
-      valid_instruments.append(_instrument)
-  return valid_instruments
-
-# Returns list of valid instruments given channel data
-def getChannelInstruments(_instruments, _channel):
-  valid_instruments = []
-  for instrument in _instruments:
-    if instrument["channel"]==_channel["name"] and _channel["amp"]>=instrument["amp_min"] and _channel["amp"]<instrument["amp_max"] and _channel["freq"]>=instrument["freq_min"] and _channel["freq"]<instrument["freq_max"]:
-      _instrument = instrument.copy()
-      valid_instruments.append(_instrument)
-  return valid_instruments
-
-# Determine instruments
-for mindex, measure in enumerate(measures):
-  _instruments = []
-  _instruments.extend(getInstruments(instruments, measure))
-  for cindex, channel in enumerate(measure["channels"]):
-    # Add instruments based on channel, phase, measure
-    _instruments.extend(getChannelInstruments(instruments, channel))
-  measures[mindex]["instruments"] = _instruments
+  values = {
+    'amp': (amps - min_amp) / (max_amp - min_amp),
+    'max': maxs,
+    'freq': (freqs - min_freq) / (max_freq - min_freq),
+    'mean_amp': (mean_amps - min_mean_amp) / (max_mean_amp - min_mean_amp),
+    'mean_freq': (mean_freqs - min_mean_freq) / (max_mean_freq - min_mean_freq),
+    'sync': 1.0 - (syncs - min_sync) / (max_sync - min_sync)
+  }
+  if 'region_sync' in features:
+    # each region separately
+    region_syncs = features['region_sync']
+    low, high = region_syncs.min(axis=0), region_syncs.max(axis=0)
+    values['region_sync'] = (region_syncs - low) / np.where(high > low, high - low, 1)
+  # Relative band powers are already between 0 and 1
+  for band, low, high in config['BANDS']:
+    values[band] = features[band]
+    values['mean_'+band] = features[band].mean(axis=1)
+  return values
+
+# Normalize the features of newly completed measures against the min/max of the measures so far, or of the last
+# STREAM_WINDOW measures, so they can be used before the rest of the recording is read. ranges holds the min/max of
+# each feature per measure between calls; returns the same values as normalizeFeatures()
+def normalizeRunning(config, features, ranges):
+  amps, freqs = features['amp'], features['freq']
+  stats = {
+    'amp': amps,
+    'freq': freqs,
+    'mean_amp': amps.mean(axis=1),
+    'mean_freq': freqs.mean(axis=1),
+    'sync': (amps.std(axis=1) + freqs.std(axis=1)) / 2.0
+  }
+  if 'sync' in features:
+    # less spread is more sync, more pairwise sync is
+    stats['sync'] = -features['sync']
+    stats['region_sync'] = features['region_sync']
+  window = config['STREAM_WINDOW']
+  values = {'max': features['max']}
+  for key, stat in stats.items():
+    # each region separately
+    axis = 0 if key == 'region_sync' else None
+    _ranges = ranges.setdefault(key, [])
+    _ranges.append((stat.min(axis=axis), stat.max(axis=axis)))
+    if window > 0:
+      del _ranges[:-window]
+    else:
+      _ranges[:] = [(np.min([low for low, high in _ranges], axis=0), np.max([high for low, high in _ranges], axis=0))]
+    low = np.min([low for low, high in _ranges], axis=0)
+    high = np.max([high for low, high in _ranges], axis=0)
+    # Until there is a range to normalize against, values are at its bottom
+    values[key] = np.where(high > low, (stat - low) / np.where(high > low, high - low, 1), 0)
+  values['sync'] = 1.0 - values['sync']
+  # Relative band powers are already between 0 and 1
+  for band, low, high in config['BANDS']:
+    values[band] = features[band]
+    values['mean_'+band] = features[band].mean(axis=1)
+  return values
+
+# Add normalized feature values to measures
+def addFeaturesToMeasures(config, _measures, values):
+  bands = config['BANDS']
+  labels = config['LABELS']
+  for mindex, measure in enumerate(_measures):
+    measure["max"] = float(values['max'][mindex].max())
+    measure["mean_amp"] = float(values['mean_amp'][mindex])
+    measure["mean_freq"] = float(values['mean_freq'][mindex])
+    measure["sync"] = float(values['sync'][mindex])
+    for band, low, high in bands:
+      measure["mean_"+band] = float(values['mean_'+band][mindex])
+    # measures[mindex]["gain"] = measures[mindex]["mean_amp"] * (MAX_GAIN-MIN_GAIN) + MIN_GAIN
+    measure["channels"] = []
+    for cindex, (_amp, _max, _freq) in enumerate(zip(values['amp'][mindex].tolist(), values['max'][mindex].tolist(), values['freq'][mindex].tolist())):
+      channel = {
+        "index": cindex,
+        "name": labels[cindex],
+        "amp": _amp,
+        "max": _max,
+        "freq": _freq
+      }
+      for band, low, high in bands:
+        channel[band] = float(values[band][mindex, cindex])
+      if 'region_sync' in values:
+        channel["sync"] = float(values['region_sync'][mindex, cindex])
+      measure["channels"].append(channel)
+
+# Compile instrument rules into (rules x features) arrays of min/max values. Measure rules (channel "all") test each
+# measure's mean amp, mean freq, sync and mean band powers; channel rules test their channel's amp, freq and band
+# powers, and with a pairwise SYNC_BACKEND the sync of their channel's region. Channel rules are ordered by channel, so matches come out in the same order as checking the measure rules
+# and then each channel's rules in turn
+def compileInstruments(config, _instruments):
+  labels = config['LABELS']
+  band_keys = [band for band, low, high in config['BANDS']]
+  measure_keys = ['amp', 'freq', 'sync'] + band_keys
+  channel_keys = ['amp', 'freq'] + band_keys
+  if config['SYNC_BACKEND'] != 'spread':
+    channel_keys.append('sync')
+  measure_rules = [instrument for instrument in _instruments if instrument['channel'] == 'all']
+  channel_rules = [instrument for instrument in _instruments if instrument['channel'] in labels]
+  channel_rules = sorted(channel_rules, key=lambda instrument: labels.index(instrument['channel']))
+  return {
+    'measure_index': np.array([instrument['index'] for instrument in measure_rules], dtype=int),
+    'measure_min': np.array([[instrument[key+'_min'] for key in measure_keys] for instrument in measure_rules]).reshape(-1, len(measure_keys)),
+    'measure_max': np.array([[instrument[key+'_max'] for key in measure_keys] for instrument in measure_rules]).reshape(-1, len(measure_keys)),
+    'channel_index': np.array([instrument['index'] for instrument in channel_rules], dtype=int),
+    'channel': np.array([labels.index(instrument['channel']) for instrument in channel_rules], dtype=int),
+    'channel_min': np.array([[instrument[key+'_min'] for key in channel_keys] for instrument in channel_rules]).reshape(-1, len(channel_keys)),
+    'channel_max': np.array([[instrument[key+'_max'] for key in channel_keys] for instrument in channel_rules]).reshape(-1, len(channel_keys))
+  }
+
+# Returns the indexes of the instruments that match each measure, given the values of normalizeFeatures(). Every
+# rule is range-tested against a batch of measures at once
+def matchInstruments(config, rules, values):
+  bands = [band for band, low, high in config['BANDS']]
+  measure_values = np.column_stack([values['mean_amp'], values['mean_freq'], values['sync']] + [values['mean_'+band] for band in bands])
+  channel_values = np.dstack([values['amp'], values['freq']] + [values[band] for band in bands] + ([values['region_sync']] if 'region_sync' in values else []))
+  indexes = np.concatenate((rules['measure_index'], rules['channel_index']))
+  measure_batch = config['MEASURE_BATCH']
+  table = []
+  for b0 in range(0, len(measure_values), measure_batch):
+    _values = measure_values[b0:b0+measure_batch, np.newaxis, :]
+    measure_matches = ((_values >= rules['measure_min']) & (_values < rules['measure_max'])).all(axis=2)
+    _values = channel_values[b0:b0+measure_batch][:, rules['channel'], :]
+    channel_matches = ((_values >= rules['channel_min']) & (_values < rules['channel_max'])).all(axis=2)
+    for matches in np.hstack((measure_matches, channel_matches)):
+      table.append(indexes[matches].tolist())
+  return table
 
 # Return if the instrument should be played in the given interval
 def isValidInterval(instrument, elapsed_ms):
   interval_ms = instrument['interval_ms']
   interval = instrument['interval']
   interval_offset = instrument['interval_offset']
-  return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
+  return np.floor(1.0*elapsed_ms/interval_ms).astype(int) % interval == interval_offset
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete):
-  radians = percent_complete * (math.pi / 2.0)
-  multiplier = math.sin(radians)
-  if multiplier < 0:
-    multiplier = 0.0
-  elif multiplier > 1:
-    multplier = 1.0
-  return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, total_ms, elapsed_ms):
+# Retrieve gain of each beat based on a sine curve
+def getGains(instrument, total_ms, elapsed_ms):
   percent_complete = elapsed_ms / total_ms
-  multiplier = getMultiplier(percent_complete)
+  radians = percent_complete * (math.pi / 2.0)
+  multiplier = np.maximum(np.sin(radians), 0)
   from_gain = instrument['from_gain']
   to_gain = instrument['to_gain']
   min_gain = min(from_gain, to_gain)
-  gain = multiplier * (to_gain - from_gain) + from_gain
-  gain = max(min_gain, round(gain, 2))
-  return gain
-
-# Add beats to sequence
-def addBeatsToSequence(_instrument, _duration, _ms, _beat_ms, _round_to):
-  global sequence
-  global hindex
+  gains = multiplier * (to_gain - from_gain) + from_gain
+  return np.maximum(min_gain, roundArray(gains, 2))
+
+# round() each value; numpy rounds halves to even, so values that are (nearly) halfway are rounded by round()
+def roundArray(values, digits):
+  rounded = np.round(values, digits)
+  scaled = values * 10 ** digits
+  halves = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+  if halves.any():
+    rounded[halves] = [round(value, digits) for value in values[halves].tolist()]
+  return rounded
+
+# For creating pseudo-random numbers for an array of indexes, same as halton()
+def haltonArray(indexes, base):
+  result = np.zeros(len(indexes))
+  f = 1.0 / base
+  i = 1.0 * np.asarray(indexes)
+  while (i > 0).any():
+    result += f * (i % base)
+    i = np.floor(i / base)
+    f = f / base
+  return result
+
+# For creating pseudo-random numbers between 0 and 1 that only depend on instrument, measure and beat (splitmix64)
+def counterRandom(instrument_index, measure_index, beats):
+  x = (np.uint64(instrument_index) << np.uint64(40)) ^ (np.uint64(measure_index) << np.uint64(16)) ^ beats.astype(np.uint64)
+  x = x + np.uint64(0x9e3779b97f4a7c15)
+  x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+  x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+  x = x ^ (x >> np.uint64(31))
+  return (x >> np.uint64(11)).astype(float) / 2.0 ** 53
+
+# Milliseconds to offset each beat by, given pseudo-random numbers between 0 and 1
+def getVariances(config, randoms):
+  variance_ms = config['VARIANCE_MS']
+  return (randoms * variance_ms * 2 - variance_ms).astype(int)
+
+# Returns (beat numbers, elapsed ms) of an instrument's beats in a measure that fall in a valid interval
+def getBeats(_instrument, _duration, _ms, _beat_ms, _round_to):
+  beat_ms = int(roundToNearest((1.0/_instrument['tempo']) * _beat_ms, _round_to))
+  offset_ms = int(_instrument['tempo_offset'] * beat_ms)
+  beats = np.arange(int(_duration) // beat_ms)
+  elapsed_ms = (_ms + offset_ms + beats * beat_ms).astype(int)
+  valid = isValidInterval(_instrument, elapsed_ms)
+  return beats[valid], elapsed_ms[valid]
+
+# Returns (beat numbers, elapsed ms) of an instrument's beats between _ms and _ms + _duration that fall in a valid
+# interval, counting beats from the start of the song rather than of the measure; used when measures overlap, as they
+# can be shorter than an instrument's beat
+def getSongBeats(_instrument, _duration, _ms, _beat_ms, _round_to):
   beat_ms = int(roundToNearest((1.0/_instrument['tempo']) * _beat_ms, _round_to))
   offset_ms = int(_instrument['tempo_offset'] * beat_ms)
-  ms = _ms + offset_ms
-  previous_ms = int(ms)
-  remaining_duration = int(_duration)
-  elapsed_duration = offset_ms
-  while remaining_duration >= beat_ms:
-    elapsed_ms = int(ms)
-    elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-    # add to sequence if in valid interval
-    if isValidInterval(_instrument, elapsed_ms):
-      h = halton(hindex, 3)
-      variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-      sequence.append({
-        'instrument_index': _instrument['index'],
-        'instrument': _instrument,
-        'position': 0,
-        'gain': getGain(_instrument, _duration, elapsed_ms),
-        'rate': 1,
-        'elapsed_ms': max([elapsed_ms + variance, 0])
-      })
-      hindex += 1
-    remaining_duration -= beat_ms
-    elapsed_duration += beat_ms
-    ms += beat_ms
-
-# Build main sequence
-ms = 0
-for measure in measures:
-  # measure_gain = sum(instrument['gain'] for instrument in measure['instruments'])
-  for instrument in measure['instruments']:
-    instrument['from_gain'] = 1.0 * instrument['from_gain'] * GAIN
-    instrument['to_gain'] = 1.0 * instrument['to_gain'] * GAIN
-    instrument['tempo'] = 1.0 * instrument['tempo'] * TEMPO
-    addBeatsToSequence(instrument, measure['duration'], ms, BEAT_MS, ROUND_TO_NEAREST)
-  ms += measure['duration']
-
-# Calculate total time
-total_seconds = int(1.0*total_ms/1000)
-print('Total sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's)')
-
-# Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-  sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-  elapsed = step['elapsed_ms']
+  first = -(-(int(_ms) - offset_ms) // beat_ms)
+  last = -(-(int(_ms + _duration) - offset_ms) // beat_ms)
+  beats = np.arange(max(first, 0), last)
+  elapsed_ms = (offset_ms + beats * beat_ms).astype(int)
+  valid = isValidInterval(_instrument, elapsed_ms)
+  return beats[valid], elapsed_ms[valid]
+
+# Apply base gain and tempo to instruments
+def getSongInstruments(config, instruments):
+  song_instruments = []
+  for instrument in instruments:
+    instrument = instrument.copy()
+    instrument['from_gain'] = 1.0 * instrument['from_gain'] * config['GAIN']
+    instrument['to_gain'] = 1.0 * instrument['to_gain'] * config['GAIN']
+    instrument['tempo'] = 1.0 * instrument['tempo'] * config['TEMPO']
+    song_instruments.append(instrument)
+  return song_instruments
+
+# Yields (streams, low_ms) for each measure, where streams are its instruments' events, each sorted by elapsed_ms and
+# numbered in the order they are generated, and low_ms is the earliest time an event of a later measure can have
+def generateEvents(config, _measures, _instruments):
+  beat_ms, round_to = config['BEAT_MS'], config['ROUND_TO_NEAREST']
+  # Overlapping measures play for less than a measure, so their beats are counted from the start of the song and
+  # their gains follow the same curve as a measure's
+  overlap = config['HOP_MS'] < config['MEASURE_MS']
+  get_beats = getSongBeats if overlap else getBeats
+  count = 0
+  ms = 0
+  min_offset_ms = 0
+  for instrument in _instruments:
+    instrument_beat_ms = int(roundToNearest((1.0/instrument['tempo']) * beat_ms, round_to))
+    min_offset_ms = min(min_offset_ms, int(instrument['tempo_offset'] * instrument_beat_ms))
+  for mindex, measure in enumerate(_measures):
+    streams = []
+    # measure_gain = sum(instrument['gain'] for instrument in measure['instruments'])
+    for index in measure['instruments']:
+      instrument = _instruments[index]
+      beats, elapsed_ms = get_beats(instrument, measure['duration'], ms, beat_ms, round_to)
+      gains = getGains(instrument, config['MEASURE_MS'] if overlap else measure['duration'], elapsed_ms)
+      if config['JITTER'] == 'counter':
+        elapsed_ms = elapsed_ms + getVariances(config, counterRandom(index, mindex, beats))
+      else:
+        # one halton number per event, in the order events are generated
+        elapsed_ms = elapsed_ms + getVariances(config, haltonArray(np.arange(count, count + len(beats)), 3))
+      elapsed_ms = np.maximum(elapsed_ms, 0)
+      numbers = np.arange(count, count + len(beats))
+      order = np.argsort(elapsed_ms, kind='mergesort')
+      streams.append((elapsed_ms[order], numbers[order], index, gains[order]))
+      count += len(beats)
+    ms += measure['duration']
+    yield streams, ms + min_offset_ms - config['VARIANCE_MS']
+
+# Merges the streams of generateEvents() with a heap into one stream sorted by elapsed ms, with ties in the order they
+# were generated. Yields (index, position, gain, rate, elapsed_ms, milliseconds) as soon as no later measure can have
+# an earlier event, so only the events of about one measure are held at a time
+def mergeEvents(measure_streams):
+  heap = []
+  elapsed = 0
+  def push(events):
+    for event in events:
+      heapq.heappush(heap, (event, events))
+      break
+  for streams, low_ms in measure_streams:
+    for elapsed_ms, numbers, index, gains in streams:
+      push(iter(zip(elapsed_ms.tolist(), numbers.tolist(), [index] * len(numbers), gains.tolist())))
+    while len(heap) > 0 and (low_ms is None or heap[0][0][0] < low_ms):
+      (elapsed_ms, number, index, gain), events = heapq.heappop(heap)
+      yield (index, 0, gain, 1, elapsed_ms, elapsed_ms - elapsed)
+      elapsed = elapsed_ms
+      push(events)
+    if low_ms is None:
+      break
+
+# Streams of generateEvents() followed by a final flush
+def generateAllEvents(config, _measures, _instruments):
+  for streams, low_ms in generateEvents(config, _measures, _instruments):
+    yield streams, low_ms
+  yield [], None
+
+# Returns the cache key of a stage's output given everything it depends on, which must be encodable as JSON
+def getCacheKey(stage, *inputs):
+  return stage + '-' + hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+# Returns a stage's output from the cache if its key has been calculated before, otherwise calculates and caches it;
+# whether it was in the cache is added to the run report
+def cached(config, key, calculate, report=None):
+  cache_dir = config['CACHE_DIR']
+  if not cache_dir:
+    return calculate()
+  filename = os.path.join(cache_dir, key + '.pkl')
+  stage = key.split('-')[0]
+  if os.path.isfile(filename):
+    if report is not None:
+      report['cache'][stage] = 'hit'
+    # mark it as recently used
+    os.utime(filename, None)
+    with open(filename, 'rb') as f:
+      return pickle.load(f)
+  if report is not None:
+    report['cache'][stage] = 'miss'
+  value = calculate()
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  # Write to a temporary file first so that parallel runs never read a partial file
+  tmp_filename = filename + '.' + str(os.getpid())
+  with open(tmp_filename, 'wb') as f:
+    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+  os.rename(tmp_filename, filename)
+  pruneCache(config, filename)
+  return value
+
+# Same as cached() for a stage that yields its output, without holding it in memory: on a miss, items are yielded as
+# they are calculated and appended to the cache file CACHE_BATCH at a time, which is only renamed into place once
+# every item has been yielded
+def cachedStream(config, key, calculate, report=None):
+  cache_dir = config['CACHE_DIR']
+  if not cache_dir:
+    for item in calculate():
+      yield item
+    return
+  filename = os.path.join(cache_dir, key + '.pkl')
+  stage = key.split('-')[0]
+  if os.path.isfile(filename):
+    if report is not None:
+      report['cache'][stage] = 'hit'
+    os.utime(filename, None)
+    with open(filename, 'rb') as f:
+      while True:
+        try:
+          batch = pickle.load(f)
+        except EOFError:
+          break
+        for item in batch:
+          yield item
+    return
+  if report is not None:
+    report['cache'][stage] = 'miss'
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  tmp_filename = filename + '.' + str(os.getpid())
+  complete = False
+  try:
+    with open(tmp_filename, 'wb') as f:
+      batch = []
+      for item in calculate():
+        batch.append(item)
+        if len(batch) >= config['CACHE_BATCH']:
+          pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+          batch = []
+        yield item
+      pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+    complete = True
+  finally:
+    # e.g. the consumer stopped early
+    if not complete and os.path.isfile(tmp_filename):
+      os.remove(tmp_filename)
+  pruneCache(config, filename)
+
+# Deletes the least recently used files in CACHE_DIR until it is under CACHE_MAX_MB, never the file just written
+def pruneCache(config, keep=None):
+  cache_dir = config['CACHE_DIR']
+  entries = []
+  for name in os.listdir(cache_dir):
+    filename = os.path.join(cache_dir, name)
+    if name.endswith('.pkl') and filename != keep:
+      try:
+        stat = os.stat(filename)
+      except OSError:
+        continue # deleted by a parallel run
+      entries.append((stat.st_mtime, stat.st_size, filename))
+  total = sum(size for mtime, size, filename in entries)
+  if keep is not None and os.path.isfile(keep):
+    total += os.path.getsize(keep)
+  for mtime, size, filename in sorted(entries):
+    if total <= config['CACHE_MAX_MB'] * 1024 * 1024:
+      break
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
+    total -= size
+
+# Identifies the configured EEG input by its path, size and modified time, and the part of it that is read
+def getInputKey(config):
+  input_format = config['EEG_INPUT_FORMAT']
+  extra = []
+  if input_format == 'edf':
+    filename = config['EDF_INPUT_FILE']
+    extra = [config['EDF_START_S'], config['EDF_END_S'], config['EEG_DIGITAL']]
+  elif input_format == 'eeg':
+    filename = config['EEG_BINARY_INPUT_FILE']
+  else:
+    filename = config['EEG_INPUT_FILE']
+  stat = os.stat(filename)
+  return [input_format, os.path.abspath(filename), stat.st_size, stat.st_mtime, config['LABELS']] + extra
+
+# Raw load stage: returns (ms, readings) of the configured EEG input. Only a parsed .csv is cached: an .eeg is
+# memory-mapped and an .edf window is read straight from its samples, both already as cheap as reading a cached copy
+def loadEEG(config, report=None):
+  if config['EEG_INPUT_FORMAT'] != 'csv':
+    return readEEG(config)
+  return cached(config, getCacheKey('load', getInputKey(config)), lambda: readEEG(config), report)
+
+# Returns the settings, besides the input, that features depend on
+def getFeatureSettings(config):
+  settings = [config['MEASURE_MS'], config['RANGE'], config['FREQUENCY_BACKEND'], config['BANDS']]
+  if config['HOP_MS'] < config['MEASURE_MS']:
+    settings.append(config['HOP_MS'])
+  if config['SYNC_BACKEND'] != 'spread':
+    settings += [config['SYNC_BACKEND'], config['SYNC_SEGMENT_MS'], config['REGIONS'], config['LABELS']]
+  return settings
+
+# Returns the cache key of the features of the configured input
+def getFeaturesKey(config):
+  return getCacheKey('features', getInputKey(config), *getFeatureSettings(config))
+
+# Feature and normalization stages: returns the duration of each measure, the total ms of the readings and the
+# normalized feature values of each measure, which depend on the input, MEASURE_MS and HOP_MS but not on the instruments.
+# eeg is the (ms, readings) of the input if they have already been loaded
+def loadFeatures(config, report=None, eeg=None):
+  def calculate():
+    times, readings = eeg if eeg is not None else timeStage(report, 'load', lambda: loadEEG(config, report))
+    durations, features = getFeatures(config, times, readings, report, readScale(config))
+    return {
+      'durations': durations,
+      'total_ms': int(times[-1]) if len(times) > 0 else 0,
+      'samples': len(times),
+      'values': timeStage(report, 'normalize', lambda: normalizeFeatures(config, features))
+    }
+  key = getFeaturesKey(config)
+  return key, cached(config, key, calculate, report)
+
+# Instrument matching stage: returns the indexes of the instruments that match each measure
+def loadMatches(config, features_key, values, instruments, report=None):
+  rules = compileInstruments(config, instruments)
+  if report is not None:
+    report['counters']['rules_evaluated'] = len(values['sync']) * (len(rules['measure_index']) + len(rules['channel_index']))
+  key = getCacheKey('match', features_key, dict((name, rule.tolist()) for name, rule in rules.items()))
+  return cached(config, key, lambda: matchInstruments(config, rules, values), report)
+
+# Sequencing stage: yields the events of mergeEvents() as they are generated or read back from the cache, so they
+# can be written without holding them all in memory
+def loadSequence(config, _measures, _instruments, report=None):
+  calculate = lambda: mergeEvents(generateAllEvents(config, _measures, _instruments))
+  if not config['CACHE_DIR']:
+    return calculate()
+  instrument_keys = ['from_gain', 'to_gain', 'tempo', 'tempo_offset', 'interval_ms', 'interval', 'interval_offset']
+  key = getCacheKey('sequence',
+    [(measure['duration'], measure['instruments']) for measure in _measures],
+    [[instrument[k] for k in instrument_keys] for instrument in _instruments],
+    config['BEAT_MS'], config['ROUND_TO_NEAREST'], config['VARIANCE_MS'], config['JITTER'])
+  return cachedStream(config, key, calculate, report)
+
+# Formats elapsed ms as minutes:seconds.ms for reports
+def formatElapsed(elapsed):
+  elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
+  ms = int(elapsed % 1000)
+  elapsed_f += '.' + str(ms)
+  return elapsed_f
+
+# Adds a file a writer has finished, and its size, to the run report
+def recordFile(report, filename):
+  if report is not None:
+    report['files'][filename] = os.path.getsize(filename)
 
 # Write instruments to file
-if WRITE_SEQUENCE and len(instruments) > 0:
-  with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
+def writeInstruments(config, instruments, report=None):
+  if len(instruments) < 1:
+    return
+  filename = config['INSTRUMENTS_OUTPUT_FILE']
+  with open(filename, 'wb') as f:
     w = csv.writer(f)
     for index, instrument in enumerate(instruments):
       w.writerow([index])
       w.writerow([instrument['file']])
     f.seek(-2, os.SEEK_END) # remove newline
     f.truncate()
-    print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+    print('Successfully wrote instruments to file: '+filename)
+  recordFile(report, filename)
 
-# Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
-  with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
-    w = csv.writer(f)
-    for step in sequence:
-      w.writerow([step['instrument_index']])
-      w.writerow([step['position']])
-      w.writerow([step['gain']])
-      w.writerow([step['rate']])
-      w.writerow([step['milliseconds']])
-    f.seek(-2, os.SEEK_END) # remove newline
-    f.truncate()
-    print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+# Writes binary sequence records; the count is filled in once all events are written
+def writeSequenceRecords(f, records):
+  if len(records) > 0:
+    f.write(np.array(records, dtype=SEQUENCE_BINARY_DTYPE).tobytes())
+
+# Writes the sequence file for brant.ck and the sequence report as events are merged; returns the number of events
+def writeSequence(config, events, instruments, buffering=-1, report=None):
+  count = 0
+  binary = config['SEQUENCE_FORMAT'] == 'binary'
+  sequence_file = None
+  if config['WRITE_SEQUENCE']:
+    sequence_file = config['SEQUENCE_BINARY_OUTPUT_FILE'] if binary else config['SEQUENCE_OUTPUT_FILE']
+  report_file = config['REPORT_SEQUENCE_OUTPUT_FILE'] if config['WRITE_REPORT'] else None
+  sequence_f = open(sequence_file, 'wb', buffering) if sequence_file else None
+  report_f = open(report_file, 'wb', buffering) if report_file else None
+  records = []
+  if sequence_f:
+    if binary:
+      sequence_f.write(np.array([0], dtype='<i4').tobytes())
+    else:
+      sequence_w = csv.writer(sequence_f)
+  if report_f:
+    report_w = csv.writer(report_f)
+    report_w.writerow(['Time', 'Instrument', 'Gain'])
+  for index, position, gain, rate, elapsed, milliseconds in events:
+    if sequence_f and binary:
+      records.append((index, position, gain, rate, milliseconds))
+      if len(records) >= config['SEQUENCE_BINARY_BATCH']:
+        writeSequenceRecords(sequence_f, records)
+        records = []
+    elif sequence_f:
+      sequence_w.writerow([index])
+      sequence_w.writerow([position])
+      sequence_w.writerow([gain])
+      sequence_w.writerow([rate])
+      sequence_w.writerow([milliseconds])
+    if report_f:
+      instrument = instruments[index]
+      report_w.writerow([formatElapsed(elapsed), instrument['file'], gain])
+    count += 1
+  if sequence_f and binary:
+    writeSequenceRecords(sequence_f, records)
+    sequence_f.seek(0)
+    sequence_f.write(np.array([count], dtype='<i4').tobytes())
+    sequence_f.close()
+    sequence_f = None
+  for f in [sequence_f, report_f]:
+    if f:
+      if count > 0:
+        f.seek(-2, os.SEEK_END) # remove newline
+        f.truncate()
+      f.close()
+  if sequence_file:
+    print('Successfully wrote sequence to file: '+sequence_file)
+    recordFile(report, sequence_file)
+  if report_file:
+    print('Successfully wrote sequence report to file: '+report_file)
+    recordFile(report, report_file)
+  return count
 
 # Write summary files
-if WRITE_REPORT:
-  with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
+def writeReports(config, _measures, report=None):
+  with open(config['REPORT_SUMMARY_OUTPUT_FILE'], 'wb') as f:
     w = csv.writer(f)
     w.writerow(['Time', 'Amplitude', 'Frequency', 'Synchrony', 'Duration'])
-    for mindex, measure in enumerate(measures):
-      elapsed = mindex * MEASURE_MS
-      elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-      ms = int(elapsed % 1000)
-      elapsed_f += '.' + str(ms)
+    for mindex, measure in enumerate(_measures):
+      elapsed_f = formatElapsed(mindex * config['HOP_MS'])
       w.writerow([elapsed_f, measure['mean_amp'], measure['mean_freq'], measure['sync'], int(measure['duration'])])
-    print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-  with open(REPORT_SUMMARY_CHANNEL_OUTPUT_FILE, 'wb') as f:
+    print('Successfully wrote summary file: '+config['REPORT_SUMMARY_OUTPUT_FILE'])
+  recordFile(report, config['REPORT_SUMMARY_OUTPUT_FILE'])
+  with open(config['REPORT_SUMMARY_CHANNEL_OUTPUT_FILE'], 'wb') as f:
     w = csv.writer(f)
-    w.writerow(LABELS)
-    for mindex, measure in enumerate(measures):
-      elapsed = mindex * MEASURE_MS
-      elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-      ms = int(elapsed % 1000)
-      elapsed_f += '.' + str(ms)
-      channels = [elapsed_f]
+    w.writerow(config['LABELS'])
+    for mindex, measure in enumerate(_measures):
+      channels = [formatElapsed(mindex * config['HOP_MS'])]
       for channel in measure["channels"]:
         channels.append(channel["amp"])
       w.writerow(channels)
-    print('Successfully wrote channel summary file: '+REPORT_SUMMARY_CHANNEL_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT and len(sequence) > 0:
-  with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-    w = csv.writer(f)
-    w.writerow(['Time', 'Instrument', 'Gain'])
-    for step in sequence:
-      instrument = instruments[step['instrument_index']]
-      elapsed = step['elapsed_ms']
-      elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-      ms = int(elapsed % 1000)
-      elapsed_f += '.' + str(ms)
-      w.writerow([elapsed_f, instrument['file'], step['gain']])
-    f.seek(-2, os.SEEK_END) # remove newline
-    f.truncate()
-    print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+    print('Successfully wrote channel summary file: '+config['REPORT_SUMMARY_CHANNEL_OUTPUT_FILE'])
+  recordFile(report, config['REPORT_SUMMARY_CHANNEL_OUTPUT_FILE'])
 
 # Write JSON data for the visualization
-if WRITE_JSON:
-  json_data = eeg
-  json_data.insert(0, eeg_max)
-  json_data.insert(0, eeg_min)
-  json_data.insert(0, LABELS)
-  with open(VISUALIZATION_OUTPUT_FILE, 'w') as outfile:
+def writeJSON(config, report=None):
+  json_data = [config['LABELS'], [], []]
+  with open(config['VISUALIZATION_OUTPUT_FILE'], 'w') as outfile:
     json.dump(json_data, outfile)
-  print('Successfully wrote to JSON file: '+VISUALIZATION_OUTPUT_FILE)
+  print('Successfully wrote to JSON file: '+config['VISUALIZATION_OUTPUT_FILE'])
+  recordFile(report, config['VISUALIZATION_OUTPUT_FILE'])
+
+# Peak memory of the process so far, in MB
+def getPeakMB():
+  return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+# Runs a stage, adding its wall time and the peak memory after it to the run report, in the order stages start.
+# A stage run inside another (e.g. load inside features) names it as its parent, and its time is part of the parent's
+def timeStage(report, name, calculate):
+  if report is None:
+    return calculate()
+  # stages that haven't finished yet enclose this one
+  running = [stage for stage in report['stages'] if 'seconds' not in stage]
+  stage = {'stage': name, 'parent': running[-1]['stage'] if len(running) > 0 else None}
+  report['stages'].append(stage)
+  start = time.time()
+  value = calculate()
+  stage['seconds'] = round(time.time() - start, 6)
+  stage['peak_mb'] = getPeakMB()
+  return value
+
+# Write the run report: stages, cache use, counters and the bytes of each output file the writers wrote
+def writeRunReport(config, report):
+  report['counters']['bytes_written'] = sum(report['files'].values())
+  with open(config['RUN_REPORT_OUTPUT_FILE'], 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print('Successfully wrote run report: '+config['RUN_REPORT_OUTPUT_FILE'])
+
+# Runs every stage for one config; returns a summary of the run. features is the (key, features) of loadFeatures()
+# if they have already been calculated, e.g. once for every variant of a sweep
+def run(config, features=None):
+  profile = None
+  if config['PROFILE']:
+    profile = cProfile.Profile()
+    profile.enable()
+  print('Building sequence at '+str(config['BPM'])+' BPM ('+str(config['BEAT_MS'])+'ms per beat)')
+
+  started = time.time()
+  report = {'started': datetime.datetime.fromtimestamp(started).isoformat(), 'stages': [], 'cache': {}, 'counters': {}, 'files': {}}
+  instruments = timeStage(report, 'instruments', lambda: readInstruments(config))
+  if features is None:
+    features_key, features = timeStage(report, 'features', lambda: loadFeatures(config, report))
+  else:
+    features_key, features = features
+    report['cache']['features'] = 'shared'
+  measures = [{"duration": duration} for duration in features['durations']]
+  total_ms = features['total_ms']
+
+  # Report EEG data
+  print('Retrieved EEG data with '+ str(config['CHANNEL_COUNT']) + ' channels')
+  print(str(len(measures)) + ' total measures created, ' + str(config['MEASURE_MS']) + 'ms each')
+  if config['HOP_MS'] < config['MEASURE_MS']:
+    print('Measures overlap, starting every ' + str(config['HOP_MS']) + 'ms')
+
+  # Add features to measures and determine instruments
+  addFeaturesToMeasures(config, measures, features['values'])
+  matches = timeStage(report, 'match', lambda: loadMatches(config, features_key, features['values'], instruments, report))
+  for mindex, _instruments in enumerate(matches):
+    measures[mindex]["instruments"] = _instruments
+  song_instruments = getSongInstruments(config, instruments)
+
+  # Calculate total time
+  total_seconds = int(1.0*total_ms/1000)
+  print('Total sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's)')
+
+  if config['WRITE_SEQUENCE']:
+    writeInstruments(config, instruments, report)
+
+  # Build main sequence and write it to file as it is generated
+  event_count = 0
+  if config['WRITE_SEQUENCE'] or config['WRITE_REPORT']:
+    events = lambda: loadSequence(config, measures, song_instruments, report)
+    event_count = timeStage(report, 'sequence', lambda: writeSequence(config, events(), instruments, report=report))
+
+  if config['WRITE_REPORT']:
+    timeStage(report, 'reports', lambda: writeReports(config, measures, report))
+
+  if config['WRITE_JSON']:
+    timeStage(report, 'json', lambda: writeJSON(config, report))
+
+  if profile is not None:
+    profile.disable()
+    profile.dump_stats(config['PROFILE_OUTPUT_FILE'])
+    print('Successfully wrote profile: '+config['PROFILE_OUTPUT_FILE'])
+    recordFile(report, config['PROFILE_OUTPUT_FILE'])
+
+  if config['WRITE_RUN_REPORT']:
+    report['seconds'] = round(time.time() - started, 6)
+    report['peak_mb'] = getPeakMB()
+    report['counters'].update({
+      # samples are only read when the features are not cached or shared
+      'samples_parsed': features.get('samples', 0) if report['cache'].get('features') not in ('hit', 'shared') else 0,
+      'measures': len(measures),
+      'events': event_count
+    })
+    writeRunReport(config, report)
+
+  return {
+    'measures': len(measures),
+    'events': event_count,
+    'total_ms': total_ms
+  }
+
+# Returns config overrides to read a recording from its .csv, .eeg or .edf path
+def getInputOverrides(path):
+  extension = os.path.splitext(path)[1].lower()
+  if extension == '.edf':
+    return {'EEG_INPUT_FORMAT': 'edf', 'EDF_INPUT_FILE': path}
+  elif extension == '.eeg':
+    return {'EEG_INPUT_FORMAT': 'eeg', 'EEG_BINARY_INPUT_FILE': path}
+  return {'EEG_INPUT_FORMAT': 'csv', 'EEG_INPUT_FILE': path}
+
+# Returns config overrides to write every output file into out_dir
+def getOutputOverrides(out_dir):
+  return dict((key, os.path.join(out_dir, os.path.basename(globals()[key]))) for key in OUTPUT_KEYS)
+
+# Returns the directory each recording's outputs go in, named after the recording; recordings with the same name
+# (e.g. a .csv and its .edf) are numbered
+def getRecordingDirs(paths, out_dir):
+  dirs = []
+  for path in paths:
+    name = os.path.splitext(os.path.basename(path))[0].replace(' ', '_')
+    recording_dir = os.path.join(out_dir, name)
+    number = 2
+    while recording_dir in dirs:
+      recording_dir = os.path.join(out_dir, name + '_' + str(number))
+      number += 1
+    dirs.append(recording_dir)
+  return dirs
+
+# Processes one recording into its own directory; run in a worker by runBatch()
+def runRecording(job):
+  path, recording_dir, overrides = job
+  if not os.path.isdir(recording_dir):
+    os.makedirs(recording_dir)
+  _overrides = dict(overrides)
+  _overrides.update(getInputOverrides(path))
+  _overrides.update(getOutputOverrides(recording_dir))
+  summary = run(getConfig(**_overrides))
+  summary['path'] = path
+  summary['dir'] = recording_dir
+  return summary
+
+# Processes many recordings across a process pool; returns the summary of each run
+def runBatch(paths, out_dir, overrides={}, processes=None):
+  jobs = [(path, recording_dir, overrides) for path, recording_dir in zip(paths, getRecordingDirs(paths, out_dir))]
+  pool = multiprocessing.Pool(processes)
+  summaries = pool.map(runRecording, jobs)
+  pool.close()
+  pool.join()
+  return summaries
+
+# Settings that choose the input; every variant of a sweep reads the same input
+INPUT_KEYS = ['LABELS', 'EEG_INPUT_FORMAT', 'EEG_INPUT_FILE', 'EEG_BINARY_INPUT_FILE', 'EDF_INPUT_FILE', 'EDF_START_S',
+              'EDF_END_S', 'EDF_CHUNK_S', 'EEG_DIGITAL']
+
+# Returns (name, overrides) of every combination of a sweep's [(key, values)], named after the values, e.g.
+# BPM-100_GAIN-0.3; list values, e.g. of BANDS, are named by their number in the sweep, e.g. BANDS-2
+def getSweepVariants(sweep):
+  variants = []
+  keys = [key for key, values in sweep]
+  for key in keys:
+    if key in INPUT_KEYS:
+      raise KeyError('Can\'t sweep an input setting: ' + key)
+  names = [[str(value) if not isinstance(value, (list, tuple, dict)) else str(i + 1) for i, value in enumerate(values)] for key, values in sweep]
+  for indexes in itertools.product(*[range(len(values)) for key, values in sweep]):
+    name = '_'.join(key + '-' + names[k][i] for k, (key, i) in enumerate(zip(keys, indexes)))
+    variants.append((name, dict((key, values[i]) for (key, values), i in zip(sweep, indexes))))
+  return variants
+
+# Parses the values of a --sweep setting: a Python list of values, e.g. "BANDS=[[...], [...]]", or values separated
+# by commas, e.g. BPM=60,75,100 or SYNC_BACKEND=correlation,coherence
+def parseSweepValues(string):
+  values = parseSetting(string)
+  if isinstance(values, (list, tuple)):
+    return list(values)
+  return [parseSetting(value) for value in string.split(',')]
+
+# Each sweep worker gets the readings, or the features of each variant, once when it starts. They are inherited
+# from the parent process rather than copied, and only read
+sweep_state = {'eeg': None, 'features': None}
+
+def setSweepState(eeg, features):
+  sweep_state['eeg'] = eeg
+  sweep_state['features'] = features
+
+# Calculates the features of one variant from the shared readings; run in a worker by runSweep()
+def loadSweepFeatures(overrides):
+  return loadFeatures(getConfig(**overrides), eeg=sweep_state['eeg'])
+
+# Builds the sequence and reports of one variant from its shared features into its own directory; run in a worker
+# by runSweep()
+def runVariant(job):
+  name, variant_dir, overrides = job
+  if not os.path.isdir(variant_dir):
+    os.makedirs(variant_dir)
+  _overrides = dict(overrides)
+  _overrides.update(getOutputOverrides(variant_dir))
+  config = getConfig(**_overrides)
+  features_key = getFeaturesKey(config)
+  summary = run(config, (features_key, sweep_state['features'][features_key]))
+  summary['name'] = name
+  summary['dir'] = variant_dir
+  return summary
+
+# Builds every variant of a sweep of settings on one input, each into its own directory under out_dir. The input is
+# loaded once; features are calculated once per measure length (e.g. per BPM) and shared by the variants that use
+# them, so only matching and sequencing are repeated. Returns the summary of each variant
+def runSweep(sweep, out_dir, overrides={}, processes=None):
+  config = getConfig(**overrides)
+  variants = getSweepVariants(sweep)
+  configs = []
+  for name, variant in variants:
+    _overrides = dict(overrides)
+    _overrides.update(variant)
+    configs.append(_overrides)
+
+  # Features of each distinct measure length, from readings loaded once
+  feature_configs = {}
+  for _overrides in configs:
+    feature_configs.setdefault(getFeaturesKey(getConfig(**_overrides)), _overrides)
+  eeg = loadEEG(config)
+  for values in eeg:
+    # a memory-mapped .eeg is already read-only
+    if isinstance(values, np.ndarray):
+      values.flags.writeable = False
+  print('Loaded ' + str(len(eeg[0])) + ' samples for ' + str(len(variants)) + ' variants, ' + str(len(feature_configs)) + ' sets of features')
+  pool = multiprocessing.Pool(processes, initializer=setSweepState, initargs=(eeg, None))
+  features = dict(pool.map(loadSweepFeatures, feature_configs.values()))
+  pool.close()
+  pool.join()
+  eeg = None
+
+  jobs = [(name, os.path.join(out_dir, name), _overrides) for (name, variant), _overrides in zip(variants, configs)]
+  pool = multiprocessing.Pool(processes, initializer=setSweepState, initargs=(None, features))
+  summaries = pool.map(runVariant, jobs)
+  pool.close()
+  pool.join()
+  return summaries
+
+# Yields (ms, reading) of each row of EEG in the .csv format written by edf2csv.py as it arrives, e.g. from stdin
+# or a socket
+def readStreamReadings(config, f):
+  header = [label.strip() for label in f.readline().strip().split(',')]
+  columns = [header.index(label) for label in config['LABELS']]
+  time_column = header.index('Time')
+  for line in iter(f.readline, ''):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    values = line.split(',')
+    yield int(values[time_column]), [float(values[column]) for column in columns]
+
+# Yields measures as soon as their readings are complete, split the same way as getMeasures(). Each measure is
+# normalized against the measures so far and matched to instruments, so events can be generated from it right away
+def streamMeasures(config, readings, instruments, _measures):
+  measure_ms = config['MEASURE_MS']
+  rules = compileInstruments(config, instruments)
+  ranges = {}
+  rows = []
+  first_ms = None
+  last_ms = None
+  sample_count = 0
+  def complete(duration):
+    measure = {"readings": np.array(rows).reshape(-1, config['CHANNEL_COUNT']), "duration": duration}
+    sample_rate = 1000.0 * (sample_count - 1) / (last_ms - first_ms) if last_ms > first_ms else 0
+    values = normalizeRunning(config, getMeasureFeatures(config, [measure], sample_rate), ranges)
+    addFeaturesToMeasures(config, [measure], values)
+    measure["instruments"] = matchInstruments(config, rules, values)[0]
+    del measure["readings"]
+    _measures.append(measure)
+    return measure
+  measure_index = None
+  for ms, reading in readings:
+    if first_ms is None:
+      first_ms = ms
+    last_ms = ms
+    sample_count += 1
+    index = int(ms // measure_ms)
+    if measure_index is not None and index != measure_index:
+      # the sample that crosses the boundary is skipped
+      yield complete(measure_ms)
+      rows = []
+    else:
+      rows.append(reading)
+    measure_index = index
+  # Add the last measure
+  if len(rows) > 0:
+    yield complete(last_ms - measure_ms * len(_measures))
+
+# Opens a stream source: '-' = stdin, otherwise host:port of a socket to read from, e.g. one served by edfstream.py
+def openStream(source):
+  if source == '-':
+    return sys.stdin
+  host, port = source.rsplit(':', 1)
+  connection = socket.create_connection((host, int(port)))
+  return connection.makefile('rb')
+
+# Reads EEG from a stream and writes the sequence as each measure completes, rather than after the whole recording is
+# read; outputs are line buffered so they can be followed while they are written, e.g. by brant.ck with
+# follow_sequence, so the sequence is always text
+def runStream(config, f):
+  if config['HOP_MS'] < config['MEASURE_MS']:
+    raise ValueError('Streamed measures can\'t overlap, set MEASURE_HOP_BEATS to 0')
+  if config['WRITE_SEQUENCE'] and config['SEQUENCE_FORMAT'] == 'binary':
+    # its event count is only written once the stream ends, so it can't be followed
+    raise ValueError('Streamed sequences can\'t be binary, set SEQUENCE_FORMAT to text')
+  print('Streaming sequence at '+str(config['BPM'])+' BPM ('+str(config['BEAT_MS'])+'ms per beat)')
+  instruments = readInstruments(config)
+  song_instruments = getSongInstruments(config, instruments)
+  if config['WRITE_SEQUENCE']:
+    writeInstruments(config, instruments)
+  measures = []
+  readings = readStreamReadings(config, f)
+  events = mergeEvents(generateAllEvents(config, streamMeasures(config, readings, instruments, measures), song_instruments))
+  event_count = writeSequence(config, events, instruments, buffering=1)
+  print(str(len(measures)) + ' total measures streamed, ' + str(config['MEASURE_MS']) + 'ms each')
+  if config['WRITE_REPORT']:
+    writeReports(config, measures)
+  return {
+    'measures': len(measures),
+    'events': event_count
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Builds a ChucK sequence and reports from EEG data')
+  parser.add_argument('recordings', nargs='*', help='.csv, .eeg or .edf recordings to process in parallel; if none, the files configured in process.py are processed')
+  parser.add_argument('--out', default=None, help='directory to write each recording\'s (or sweep variant\'s) outputs to, in a directory named after it; defaults to output/batch (or output/sweep)')
+  parser.add_argument('--processes', type=int, default=None, help='number of recordings (or sweep variants) to process at once; defaults to the number of CPUs')
+  parser.add_argument('--start', type=float, default=None, help='seconds into each .edf to start at')
+  parser.add_argument('--end', type=float, default=None, help='seconds into each .edf to end at')
+  parser.add_argument('--stream', nargs='?', const='-', default=None, metavar='SOURCE', help='read EEG as it arrives from stdin (-) or host:port, in edf2csv.py\'s .csv format, and write the sequence as each measure completes')
+  parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a config value with a Python literal, e.g. BPM=100, PROFILE=False or "RANGE=[-50, 50]"')
+  parser.add_argument('--sweep', action='append', default=[], metavar='KEY=VALUES', help='build a variant for every combination of these comma-separated values, e.g. BPM=60,75,100, or Python list of values, e.g. "RANGE=[[-50, 50], [-100, 100]]", from one load of the input (or the one recording given)')
+  args = parser.parse_args()
+
+  overrides = {}
+  for setting in args.set:
+    key, value = setting.split('=', 1)
+    overrides[key] = parseSetting(value)
+
+  if len(args.sweep) > 0:
+    if len(args.recordings) > 1:
+      parser.error('a sweep takes at most one recording')
+    if len(args.recordings) > 0:
+      overrides.update(getInputOverrides(args.recordings[0]))
+      overrides['EDF_START_S'] = args.start if args.start is not None else 0
+      overrides['EDF_END_S'] = args.end
+    sweep = []
+    for setting in args.sweep:
+      key, values = setting.split('=', 1)
+      sweep.append((key, parseSweepValues(values)))
+    for summary in runSweep(sweep, args.out or 'output/sweep', overrides, args.processes):
+      print('%s: %s measures, %s events written to %s' % (summary['name'], summary['measures'], summary['events'], summary['dir']))
+  elif args.stream is not None:
+    runStream(getConfig(**overrides), openStream(args.stream))
+  elif len(args.recordings) < 1:
+    run(getConfig(**overrides))
+  else:
+    # Recordings are processed whole unless a range is given
+    overrides['EDF_START_S'] = args.start if args.start is not None else 0
+    overrides['EDF_END_S'] = args.end
+    for summary in runBatch(args.recordings, args.out or 'output/batch', overrides, args.processes):
+      print('%s: %s measures, %s events written to %s' % (summary['path'], summary['measures'], summary['events'], summary['dir']))
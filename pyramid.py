@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Builds a .pyr file next to each .edf: the min, max and mean of every channel over buckets of samples, at every
+# power-of-two multiple of BUCKET_SAMPLES, so any time range of a recording can be summarized at any zoom by reading
+# about as many buckets as there are points to draw, however long the range is, e.g. to find passages worth extracting
+# with edf2csv.py. Run with no arguments to build the missing or outdated .pyr files in IN_DIR; with a file and a range,
+#   python pyramid.py "data/GUICHARD 081217.edf" 21000 22000
+# prints the range's amplitude over POINTS buckets.
+
+import eegio
+import multiprocessing
+import numpy as np
+import os
+import sys
+
+IN_DIR = "data"
+BUCKET_SAMPLES = 256 # samples in each bucket of the finest level; each level up has buckets twice as long
+CHUNK_S = 600 # seconds of samples to read from the .edf at a time
+POINTS = 40 # buckets to print a range in
+PROCESSES = None # number of .edf files to build at once; None = number of CPUs
+LABELS = eegio.LABELS # channels to read, in order
+
+# .pyr: a fixed-size JSON header (see eegio.writeHeader()) followed by each level, finest first, as a
+# (buckets x channels x 3) matrix of little-endian float32 min, max and mean
+PYR_MAGIC = 'BRANTPYR'
+PYR_DTYPE = '<f4'
+
+def getPyramidFilename(edfFilename):
+    return os.path.splitext(edfFilename)[0] + ".pyr"
+
+# Yields (mins, maxs, means, counts) of consecutive buckets of BUCKET_SAMPLES of (ms, rows) chunks; the last bucket
+# has the samples left over
+def getBuckets(chunks):
+    carry = None
+    for ms, rows in chunks:
+        if carry is not None:
+            rows = np.concatenate((carry, rows))
+        n = len(rows) // BUCKET_SAMPLES * BUCKET_SAMPLES
+        carry = rows[n:]
+        if n > 0:
+            buckets = rows[:n].reshape(-1, BUCKET_SAMPLES, rows.shape[1])
+            yield buckets.min(axis=1), buckets.max(axis=1), buckets.mean(axis=1), np.full(len(buckets), BUCKET_SAMPLES)
+    if carry is not None and len(carry) > 0:
+        yield carry.min(axis=0)[np.newaxis], carry.max(axis=0)[np.newaxis], carry.mean(axis=0)[np.newaxis], np.array([len(carry)])
+
+# Combines each pair of buckets of a level into the next level's
+def getNextLevel(mins, maxs, means, counts):
+    pairs = np.arange(0, len(counts), 2)
+    nextCounts = np.add.reduceat(counts, pairs)
+    nextMeans = np.add.reduceat(means * counts[:, np.newaxis], pairs, axis=0) / nextCounts[:, np.newaxis]
+    return np.minimum.reduceat(mins, pairs, axis=0), np.maximum.reduceat(maxs, pairs, axis=0), nextMeans, nextCounts
+
+# Builds the .pyr of an .edf; returns its filename
+def writePyramid(edfFilename):
+    filename = getPyramidFilename(edfFilename)
+    f, channels, samplesPerSecond = eegio.openEdf(edfFilename, LABELS)
+    start = f.getStartdatetime()
+    try:
+        buckets = list(getBuckets(eegio.readChunks(f, channels, samplesPerSecond, 0, None, CHUNK_S)))
+    finally:
+        f._close()
+    if len(buckets) < 1:
+        raise ValueError('%s has no samples' % edfFilename)
+    level = [np.concatenate([bucket[i] for bucket in buckets]) for i in range(4)]
+    samples = int(level[3].sum())
+
+    # Levels up to a single bucket
+    levels = []
+    offset = eegio.HEADER_SIZE
+    with open(filename + ".tmp", 'wb') as out:
+        out.write(' ' * eegio.HEADER_SIZE)
+        while True:
+            data = np.dstack(level[:3]).astype(PYR_DTYPE)
+            out.write(data.tobytes())
+            levels.append({"offset": offset, "buckets": len(data), "bucket_samples": BUCKET_SAMPLES * 2 ** len(levels)})
+            offset += data.nbytes
+            if len(data) <= 1:
+                break
+            level = getNextLevel(*level)
+        stat = os.stat(edfFilename)
+        header = {
+            "labels": LABELS,
+            "sample_rate": samplesPerSecond,
+            "samples": samples,
+            "start": start.isoformat(),
+            "edf_size": stat.st_size,
+            "edf_mtime": stat.st_mtime,
+            "levels": levels,
+            "dtype": PYR_DTYPE
+        }
+        eegio.writeHeader(out, PYR_MAGIC, header)
+    os.rename(filename + ".tmp", filename)
+    return filename
+
+# Returns (header, levels) of a .pyr, where each level is a read-only (buckets x channels x 3) np.memmap of min, max
+# and mean, so reading a range only reads its buckets
+def readPyramid(filename):
+    header = eegio.readHeader(filename, PYR_MAGIC)
+    levels = []
+    for level in header["levels"]:
+        shape = (level["buckets"], len(header["labels"]), 3)
+        levels.append(np.memmap(filename, dtype=header["dtype"], mode='r', offset=level["offset"], shape=shape))
+    return header, levels
+
+# Returns (seconds each bucket starts at, mins, maxs, means), where mins, maxs and means are (buckets x channels), of
+# the time between start_s and end_s at the finest level with at most points buckets in it (or the coarsest level)
+def readRange(pyramid, start_s, end_s, points):
+    header, levels = pyramid
+    samplesPerSecond = header["sample_rate"]
+    for i, level in enumerate(header["levels"]):
+        seconds = 1.0 * level["bucket_samples"] / samplesPerSecond
+        b0 = max(int(start_s / seconds), 0)
+        b1 = min(int(np.ceil(end_s / seconds)), level["buckets"])
+        if b1 - b0 <= points or i == len(levels) - 1:
+            break
+    data = np.array(levels[i][b0:b1], dtype=float)
+    return np.arange(b0, b1) * seconds, data[:, :, 0], data[:, :, 1], data[:, :, 2]
+
+# Whether an .edf's .pyr is missing or was built from a different version of it
+def isOutdated(edfFilename):
+    filename = getPyramidFilename(edfFilename)
+    if not os.path.isfile(filename):
+        return True
+    header = eegio.readHeader(filename, PYR_MAGIC)
+    stat = os.stat(edfFilename)
+    return header["edf_size"] != stat.st_size or header["edf_mtime"] != stat.st_mtime or header["levels"][0]["bucket_samples"] != BUCKET_SAMPLES
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        edfFilename, start_s, end_s = sys.argv[1], float(sys.argv[2]), float(sys.argv[3])
+        if isOutdated(edfFilename):
+            writePyramid(edfFilename)
+        pyramid = readPyramid(getPyramidFilename(edfFilename))
+        seconds, mins, maxs, means = readRange(pyramid, start_s, end_s, POINTS)
+        print "%-10s %12s %12s" % ("seconds", "mean range", "max range")
+        for s, ranges in zip(seconds, maxs - mins):
+            print "%-10s %12s %12s" % (s, round(ranges.mean(), 2), round(ranges.max(), 2))
+        sys.exit(0)
+
+    edfFilenames = [os.path.join(IN_DIR, name) for name in sorted(os.listdir(IN_DIR)) if name.endswith(".edf")]
+    edfFilenames = [edfFilename for edfFilename in edfFilenames if isOutdated(edfFilename)]
+    pool = multiprocessing.Pool(PROCESSES)
+    for filename in pool.imap_unordered(writePyramid, edfFilenames):
+        print "Built %s" % filename
+    pool.close()
+    pool.join()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# Renders the sequence written by process.py to a .wav file, the same way brant.ck plays it but faster than real time
+
+import multiprocessing
+import numpy as np
+import os
+import struct
+import wave
+
+INSTRUMENTS_FILE = "data/ck_instruments.csv"
+SEQUENCE_FILE = "data/ck_sequence.csv" # or data/ck_sequence.bin, written by process.py with SEQUENCE_FORMAT = 'binary'
+OUTPUT_FILE = "output/brant.wav"
+SAMPLE_RATE = 44100 # output samples per second; instruments with a different rate are resampled, as ChucK does
+PADDING = 4000 # ms of silence before and after the sequence, same as brant.ck's padding
+INSTRUMENT_BUFFERS = 2 # voices per instrument, same as brant.ck's instrument_buffers; each play cuts off the note its voice played before
+START = 0 # ms into the sequence to start at, same as brant.ck's start
+RANGE_MS = None # (start ms, end ms) of the rendered song to write, e.g. (60000, 120000); None = the whole song
+STEMS = False # also write each instrument to its own file, e.g. output/brant_0.wav
+SEGMENT_S = 60 # seconds of audio rendered by a process at a time
+PROCESSES = None # number of segments to render at once; None = number of CPUs
+
+# Reads a PCM or floating point .wav into a (frames x channels) float32 array between -1 and 1; returns (array, sample rate)
+def readWav(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != 'RIFF' or data[8:12] != 'WAVE':
+        raise ValueError('%s is not a .wav file' % filename)
+    formatTag = None
+    frames = None
+    i = 12
+    while i + 8 <= len(data):
+        chunkId = data[i:i+4]
+        size = struct.unpack('<I', data[i+4:i+8])[0]
+        chunk = data[i+8:i+8+size]
+        if chunkId == 'fmt ':
+            formatTag, channels, sampleRate = struct.unpack('<HHI', chunk[:8])
+            bits = struct.unpack('<H', chunk[14:16])[0]
+            # extensible format: the actual format is the start of the sub-format GUID
+            if formatTag == 0xFFFE:
+                formatTag = struct.unpack('<H', chunk[24:26])[0]
+        elif chunkId == 'data':
+            frames = chunk
+        i += 8 + size + size % 2
+    if formatTag is None or frames is None:
+        raise ValueError('%s has no fmt or data chunk' % filename)
+
+    if formatTag == 3 and bits in (32, 64):
+        values = np.frombuffer(frames, dtype='<f%s' % (bits / 8)).astype(np.float32)
+    elif formatTag == 1 and bits == 8:
+        values = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif formatTag == 1 and bits == 16:
+        values = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 2 ** 15
+    elif formatTag == 1 and bits == 24:
+        b = np.frombuffer(frames[:len(frames) // 3 * 3], dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = ((b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8 >> 8).astype(np.float32) / 2 ** 23
+    elif formatTag == 1 and bits == 32:
+        values = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2 ** 31
+    else:
+        raise ValueError('%s has an unsupported format (%s, %s bits)' % (filename, formatTag, bits))
+    values = values[:len(values) // channels * channels]
+    return values.reshape(-1, channels), sampleRate
+
+# Reads the instruments file written by process.py into a dict of index => filename
+def readInstruments(filename):
+    with open(filename, 'rb') as f:
+        lines = [line.strip() for line in f]
+    return dict((int(lines[i]), lines[i+1]) for i in range(0, len(lines) - 1, 2))
+
+# Reads the sequence file written by process.py into an (events x 5) array of index, position, gain, rate, milliseconds
+def readSequence(filename):
+    if filename.endswith(".bin"):
+        dtype = [('index', '<i4'), ('position', '<i4'), ('gain', '<f4'), ('rate', '<f4'), ('milliseconds', '<i4')]
+        with open(filename, 'rb') as f:
+            count = np.fromfile(f, dtype='<i4', count=1)[0]
+            records = np.fromfile(f, dtype=dtype, count=count)
+        return np.column_stack([records[name].astype(float) for name, t in dtype])
+    values = np.loadtxt(filename, ndmin=1)
+    return values.reshape(-1, 5)
+
+# Decodes each instrument once; like SndBuf, only the first channel of each file is played
+def loadSamples(instruments):
+    samples = {}
+    for index, filename in instruments.items():
+        values, sampleRate = readWav(filename)
+        samples[index] = (np.ascontiguousarray(values[:, 0]), sampleRate)
+    return samples
+
+# Works out when and how long each event of the sequence plays, as brant.ck would play it. Returns (notes, total
+# samples), where notes is a dict of (events) arrays: instrument index, start sample, length in samples, position,
+# gain and step (samples of the instrument per output sample)
+def getNotes(sequence, samples):
+    index = sequence[:, 0].astype(int)
+    milliseconds = sequence[:, 4]
+
+    # Events before START are skipped without waiting
+    elapsed = PADDING + np.cumsum(milliseconds)
+    played = elapsed >= START
+    now = PADDING + np.cumsum(np.where(played, milliseconds, 0))
+    totalMs = (now[-1] if len(now) > 0 else PADDING) + PADDING
+    index, now, sequence = index[played], now[played], sequence[played]
+    starts = np.round(now * SAMPLE_RATE / 1000.0).astype(int)
+    n = len(index)
+
+    # Each instrument plays its voices in turn
+    order = np.argsort(index, kind='mergesort')
+    groupStarts = np.flatnonzero(np.concatenate(([True], np.diff(index[order]) != 0)))
+    groupSizes = np.diff(np.append(groupStarts, n))
+    plays = np.empty(n, dtype=int)
+    plays[order] = np.arange(n) - np.repeat(groupStarts, groupSizes)
+    voices = index * INSTRUMENT_BUFFERS + plays % INSTRUMENT_BUFFERS
+
+    # A note plays until the next play of its voice
+    order = np.argsort(voices, kind='mergesort')
+    nextStarts = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    sameVoice = voices[order][1:] == voices[order][:-1]
+    nextStarts[order[:-1][sameVoice]] = starts[order[1:][sameVoice]]
+
+    # ...or until the end of its sample
+    position = sequence[:, 1]
+    sampleLengths = np.array([len(samples[i][0]) for i in index], dtype=float)
+    steps = sequence[:, 3] * np.array([samples[i][1] for i in index], dtype=float) / SAMPLE_RATE
+    # only forward playback is rendered
+    lengths = np.where(steps > 0, np.ceil((sampleLengths - position) / np.where(steps > 0, steps, 1)), 0)
+    lengths = np.maximum(np.minimum(lengths, nextStarts - starts), 0).astype(int)
+
+    notes = {
+        "index": index,
+        "start": starts,
+        "length": lengths,
+        "position": position,
+        "gain": sequence[:, 2],
+        "step": steps
+    }
+    return notes, int(round(totalMs * SAMPLE_RATE / 1000.0))
+
+# Each worker gets the notes and decoded samples once, when it starts
+state = {"notes": None, "samples": None}
+
+def setState(notes, samples):
+    state["notes"] = notes
+    state["samples"] = samples
+
+# Mixes the notes that play between output samples s0 and s1, optionally only those of one instrument
+def renderRange(job):
+    instrumentIndex, s0, s1 = job
+    notes, samples = state["notes"], state["samples"]
+    out = np.zeros(s1 - s0, dtype=np.float32)
+    starts, ends = notes["start"], notes["start"] + notes["length"]
+    selected = (starts < s1) & (ends > s0)
+    if instrumentIndex is not None:
+        selected &= notes["index"] == instrumentIndex
+    for i in np.flatnonzero(selected):
+        data = samples[notes["index"][i]][0]
+        start = starts[i]
+        k0, k1 = max(s0, start) - start, min(s1, ends[i]) - start
+        step = notes["step"][i]
+        position = notes["position"][i]
+        if step == 1 and position == int(position):
+            values = data[int(position)+k0:int(position)+k1]
+        else:
+            values = np.interp(position + np.arange(k0, k1) * step, np.arange(len(data)), data, right=0)
+        out[start+k0-s0:start+k0-s0+len(values)] += notes["gain"][i] * values
+    return out
+
+# Renders the samples between s0 and s1 to a 16-bit mono .wav, SEGMENT_S at a time across the pool
+def writeWav(pool, filename, instrumentIndex, s0, s1):
+    segment = SEGMENT_S * SAMPLE_RATE
+    jobs = [(instrumentIndex, s, min(s + segment, s1)) for s in range(s0, s1, segment)]
+    w = wave.open(filename, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLE_RATE)
+    for out in pool.imap(renderRange, jobs):
+        w.writeframes((np.clip(out, -1, 1) * (2 ** 15 - 1)).astype('<i2').tobytes())
+    w.close()
+    print "Wrote %s (%ss)" % (filename, round(1.0 * (s1 - s0) / SAMPLE_RATE, 3))
+
+if __name__ == "__main__":
+    instruments = readInstruments(INSTRUMENTS_FILE)
+    samples = loadSamples(instruments)
+    sequence = readSequence(SEQUENCE_FILE)
+    notes, totalSamples = getNotes(sequence, samples)
+    print "%s events, %s instruments, %ss" % (len(notes["index"]), len(instruments), round(1.0 * totalSamples / SAMPLE_RATE, 3))
+
+    s0, s1 = 0, totalSamples
+    if RANGE_MS is not None:
+        s0 = min(int(round(RANGE_MS[0] * SAMPLE_RATE / 1000.0)), totalSamples)
+        s1 = min(int(round(RANGE_MS[1] * SAMPLE_RATE / 1000.0)), totalSamples)
+
+    outDir = os.path.dirname(OUTPUT_FILE)
+    if outDir and not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    pool = multiprocessing.Pool(PROCESSES, initializer=setState, initargs=(notes, samples))
+    writeWav(pool, OUTPUT_FILE, None, s0, s1)
+    if STEMS:
+        base = os.path.splitext(OUTPUT_FILE)[0]
+        for index in sorted(set(notes["index"].tolist())):
+            writeWav(pool, "%s_%s.wav" % (base, index), index, s0, s1)
+    pool.close()
+    pool.join()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# Serves sequences from a local HTTP server that keeps loaded recordings, the features of their measures and compiled
+# instrument rules in memory, so an interactive tool can hear a different window or rule without a process.py run, e.g.
+#   python serve.py &
+#   curl -d '{"recording": "output/GUICHARD_081217.csv", "start_s": 60, "end_s": 120, "config": {"BPM": 100},
+#             "rules": {"0": {"amp_min": 0.2}, "Drum 1": {"active": 0}}}' localhost:8766/sequence
+# responds with the instruments and the sequence brant.ck would play, as JSON. GET /status lists what is cached.
+
+import BaseHTTPServer
+from collections import OrderedDict
+import json
+import numpy as np
+import os
+import process
+import sys
+import time
+
+PORT = 8766 # served on localhost only
+MEMORY_MB = 1024 # least recently used recordings, features and rules are dropped to keep the cache under this
+MAX_BODY_BYTES = 1024 * 1024
+INSTRUMENT_KEYS = ['name', 'channel', 'amp_min', 'amp_max', 'freq_min', 'freq_max', 'sync_min', 'sync_max', 'delta_min',
+                   'delta_max', 'theta_min', 'theta_max', 'alpha_min', 'alpha_max', 'beta_min', 'beta_max', 'from_gain',
+                   'to_gain', 'tempo', 'tempo_offset', 'interval_ms', 'interval', 'interval_offset', 'active']
+
+# key => (value, bytes), least recently used first
+cache = {"entries": OrderedDict(), "bytes": 0}
+
+# Bytes a cached value holds in memory; memory-mapped readings (e.g. of an .eeg) are paged in and out by the OS, so
+# they are not counted
+def sizeOf(value):
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeOf(k) + sizeOf(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeOf(v) for v in value)
+    return sys.getsizeof(value)
+
+# Returns a value from the cache, or calculates and caches it, dropping the least recently used values while the cache
+# is over MEMORY_MB; hits is a dict the stage's hit or miss is added to
+def getCached(key, calculate, hits):
+    entries = cache["entries"]
+    stage = key.split('-')[0]
+    if key in entries:
+        value, size = entries.pop(key)
+        entries[key] = (value, size)
+        hits[stage] = 'hit'
+        return value
+    hits[stage] = 'miss'
+    value = calculate()
+    size = sizeOf(value)
+    entries[key] = (value, size)
+    cache["bytes"] += size
+    while cache["bytes"] > MEMORY_MB * 1024 * 1024 and len(entries) > 1:
+        _key, (_value, _size) = entries.popitem(last=False)
+        cache["bytes"] -= _size
+    return value
+
+# Returns (ms, readings) of a recording: all of a .csv or .eeg, or just the window of an .edf, which is read in chunks
+def loadRecording(config, hits):
+    return getCached(process.getCacheKey('recording', process.getInputKey(config)), lambda: process.readEEG(config), hits)
+
+# Returns the durations and normalized feature values of the measures of a window of a recording; measures start at
+# the start of the window
+def loadFeatures(config, startS, endS, hits):
+    def calculate():
+        times, readings = loadRecording(config, hits)
+        if config['EEG_INPUT_FORMAT'] != 'edf':
+            i0, i1 = np.searchsorted(times, [startS * 1000.0, endS * 1000.0 if endS is not None else np.inf])
+            times, readings = times[i0:i1], readings[i0:i1]
+        if len(times) < 1:
+            raise ValueError('No readings between %ss and %ss' % (startS, endS))
+        times = times - times[0]
+        durations, features = process.getFeatures(config, times, readings, scale=process.readScale(config))
+        return {
+            "durations": durations,
+            "values": process.normalizeFeatures(config, features)
+        }
+    key = process.getCacheKey('features', process.getInputKey(config), startS, endS, *process.getFeatureSettings(config))
+    return getCached(key, calculate, hits)
+
+# Returns the instruments file's instruments with a request's overrides applied: a dict of instrument => {key: value},
+# where an instrument is its row number in the file (from 0, counting inactive rows) or its name if no other row has
+# it. Instruments overridden with active 0 are left out, and active 1 adds an inactive one
+def loadInstruments(config, rules, hits):
+    # every instrument, so that inactive ones can be turned on
+    calculate = lambda: process.readInstruments(config, include_inactive=True)
+    stat = os.stat(config['INSTRUMENTS_INPUT_FILE'])
+    key = process.getCacheKey('instruments', config['INSTRUMENTS_INPUT_FILE'], stat.st_size, stat.st_mtime, config['BEAT_MS'],
+        config['INSTRUMENTS_DIR'])
+    allInstruments = getCached(key, calculate, hits)
+    names = [instrument['name'] for instrument in allInstruments]
+    rowOverrides = {}
+    for name, overrides in rules.items():
+        if str(name).isdigit() and int(name) < len(allInstruments):
+            row = int(name)
+        elif names.count(name) == 1:
+            row = names.index(name)
+        elif name in names:
+            raise KeyError('%s instruments are named %s, use a row number' % (names.count(name), name))
+        else:
+            raise KeyError('Unknown instrument: %s' % name)
+        for key in overrides:
+            if key not in INSTRUMENT_KEYS or key == 'name':
+                raise KeyError('Unknown instrument setting: ' + key)
+        rowOverrides.setdefault(row, {}).update(overrides)
+    instruments = []
+    for row, instrument in enumerate(allInstruments):
+        instrument = instrument.copy()
+        instrument.update(rowOverrides.get(row, {}))
+        if int(instrument['active']):
+            instrument['index'] = len(instruments)
+            instruments.append(instrument)
+    return instruments
+
+# Returns the compiled rules of instruments, see process.compileInstruments()
+def loadRules(config, instruments, hits):
+    keys = [key for key in INSTRUMENT_KEYS if key.endswith('_min') or key.endswith('_max')] + ['index', 'channel']
+    key = process.getCacheKey('rules', [[instrument[k] for k in keys] for instrument in instruments], config['LABELS'], config['BANDS'],
+        config['SYNC_BACKEND'])
+    return getCached(key, lambda: process.compileInstruments(config, instruments), hits)
+
+# Builds the sequence of a request: a dict of recording (a .csv, .eeg or .edf path), start_s and end_s (optional
+# window of it, in seconds), config (process.py settings to override) and rules (instrument overrides, see
+# loadInstruments()). Returns the instruments' files and the sequence's events as the index, position, gain, rate and
+# milliseconds that brant.ck reads, with the elapsed ms of each event
+def getSequence(request):
+    started = time.time()
+    hits = {}
+    startS = request.get('start_s', 0)
+    endS = request.get('end_s', None)
+    overrides = dict((str(key), value) for key, value in request.get('config', {}).items())
+    overrides.update(process.getInputOverrides(request['recording']))
+    overrides.update({'EDF_START_S': startS, 'EDF_END_S': endS})
+    config = process.getConfig(**overrides)
+
+    features = loadFeatures(config, startS, endS, hits)
+    instruments = loadInstruments(config, request.get('rules', {}), hits)
+    rules = loadRules(config, instruments, hits)
+    measures = [{"duration": duration} for duration in features["durations"]]
+    for mindex, _instruments in enumerate(process.matchInstruments(config, rules, features["values"])):
+        measures[mindex]["instruments"] = _instruments
+    songInstruments = process.getSongInstruments(config, instruments)
+    events = process.mergeEvents(process.generateAllEvents(config, measures, songInstruments))
+    return {
+        "instruments": [instrument['file'] for instrument in instruments],
+        "sequence": [[index, position, gain, rate, milliseconds, elapsed] for index, position, gain, rate, elapsed, milliseconds in events],
+        "measures": len(measures),
+        "cache": hits,
+        "seconds": round(time.time() - started, 6)
+    }
+
+# Returns what is in the cache, least recently used first
+def getStatus():
+    return {
+        "entries": [{"key": key, "bytes": size} for key, (value, size) in cache["entries"].items()],
+        "bytes": cache["bytes"],
+        "max_bytes": MEMORY_MB * 1024 * 1024
+    }
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.respond(200, getStatus())
+        else:
+            self.respond(404, {"error": "Not found: %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/sequence":
+            self.respond(404, {"error": "Not found: %s" % self.path})
+            return
+        length = int(self.headers.getheader("Content-Length", 0))
+        if length > MAX_BODY_BYTES:
+            self.respond(413, {"error": "Request is over %s bytes" % MAX_BODY_BYTES})
+            return
+        try:
+            response = getSequence(json.loads(self.rfile.read(length)))
+        except (KeyError, ValueError, TypeError, IOError, OSError) as e:
+            self.respond(400, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        self.respond(200, response)
+
+if __name__ == "__main__":
+    # One request at a time, so the cache needs no locking
+    server = BaseHTTPServer.HTTPServer(("localhost", PORT), Handler)
+    print "Serving sequences on localhost:%s" % PORT
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()